@@ -1,4 +1,7 @@
 from git_of_theseus.analyze import analyze, analyze_cmdline
+from git_of_theseus.batch import batch_analyze, batch_analyze_cmdline
+from git_of_theseus.merge import merge_shards, merge_shards_cmdline
+from git_of_theseus.benchmark import benchmark, benchmark_cmdline
 from git_of_theseus.survival_plot import survival_plot, survival_plot_cmdline
 from git_of_theseus.stack_plot import stack_plot, stack_plot_cmdline
 from git_of_theseus.line_plot import line_plot, line_plot_cmdline
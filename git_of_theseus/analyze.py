@@ -15,20 +15,40 @@
 # limitations under the License.
 
 import argparse
+import bisect
+import calendar
+import collections
+import cProfile
 import datetime
 import functools
+import gc
+import itertools
 import json
 import multiprocessing
 import os
+import pickle
+import queue
+import re
+import shutil
 import signal
+import subprocess
+import tempfile
+import threading
+import time
+import traceback
 import warnings
 from pathlib import Path
 
 import git
-import pygments.lexers
+import numpy
+import pygments
 from tqdm import tqdm
 from wcmatch import fnmatch
 
+from .cache import BlameCache
+from .metrics import get_peak_rss_mb, get_rss_mb, write_metrics
+from .spill import CurveSpill, HistorySpill
+
 # Some filetypes in Pygments are not necessarily computer code, but configuration/documentation. Let's not include those.
 IGNORE_PYGMENTS_FILETYPES = [
     "*.json",
@@ -47,22 +67,199 @@ IGNORE_PYGMENTS_FILETYPES = [
     "*.yml",
 ]
 
-default_filetypes = set()
-for _, _, filetypes, _ in pygments.lexers.get_all_lexers():
-    default_filetypes.update(filetypes)
-default_filetypes.difference_update(IGNORE_PYGMENTS_FILETYPES)
+
+@functools.lru_cache(maxsize=None)
+def get_default_filetypes():
+    # Listing all Pygments lexers is slow, so only do it when it's needed, and keep the result on disk
+    # for each Pygments version
+    cache_fn = os.path.join(
+        os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")),
+        "git-of-theseus",
+        "filetypes-{:s}.json".format(pygments.__version__),
+    )
+    try:
+        with open(cache_fn) as f:
+            return frozenset(json.load(f))
+    except (OSError, ValueError):
+        pass
+
+    from pygments.lexers import get_all_lexers
+
+    default_filetypes = set()
+    for _, _, filetypes, _ in get_all_lexers():
+        default_filetypes.update(filetypes)
+    default_filetypes.difference_update(IGNORE_PYGMENTS_FILETYPES)
+    try:
+        os.makedirs(os.path.dirname(cache_fn), exist_ok=True)
+        with open(cache_fn, "w") as f:
+            json.dump(sorted(default_filetypes), f)
+    except OSError:
+        pass  # Not being able to cache it is fine
+    return frozenset(default_filetypes)
+
+
+def __getattr__(name):
+    if name == "default_filetypes":  # Used to be computed when importing this module
+        return get_default_filetypes()
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+
+
+# Characters that make a glob pattern more than a literal file name
+GLOB_MAGIC_RE = re.compile(r"[*?\[\](){}|!@+\\]")
+
+
+def compile_globs(patterns, flags):
+    # Translates glob patterns into a pair of compiled (include, exclude) regexes
+    include, exclude = fnmatch.translate(patterns, flags=flags)
+    return tuple(
+        re.compile("|".join("(?:%s)" % r for r in regexes)) if regexes else None
+        for regexes in (include, exclude)
+    )
+
+
+class PathFilter:
+    """Compiled version of the --only, --ignore & filetype filters.
+
+    Filetype patterns like `*.py` or `Makefile` are plain suffix & file name lookups, and everything
+    else is compiled into regexes once, instead of going through `fnmatch.fnmatch` for every path.
+    """
+
+    def __init__(self, only, ignore, all_filetypes, filetypes):
+        self.all_filetypes = all_filetypes
+        self.suffixes = set()
+        self.basenames = set()
+        patterns = []
+        for pattern in filetypes:
+            if not GLOB_MAGIC_RE.search(pattern):
+                self.basenames.add(pattern)
+            elif pattern.startswith("*.") and not GLOB_MAGIC_RE.search(pattern[1:]):
+                self.suffixes.add(pattern[1:])
+            else:
+                patterns.append(pattern)
+        self.filetype_re, _ = compile_globs(patterns, fnmatch.EXTMATCH)
+
+        if ignore and not only:
+            only = ["**"]  # stupid fix
+        self.path_match_zero = len(only) == 0 and len(ignore) == 0
+        self.include_re, self.exclude_re = compile_globs(
+            "{:s}|!+({:s})".format("|".join(only), "|".join(ignore)),
+            fnmatch.NEGATE | fnmatch.EXTMATCH | fnmatch.SPLIT,
+        )
+        # Identifies the filter in the blame cache, which remembers the result for each path
+        self.key = json.dumps([only, ignore, all_filetypes, sorted(filetypes)])
+
+    def filetype_ok(self, path):
+        basename = os.path.split(path)[-1]
+        if basename in self.basenames:
+            return True
+        if not basename.startswith("."):  # `*` doesn't match a leading dot
+            i = basename.find(".", 1)
+            while i != -1:
+                if basename[i:] in self.suffixes:
+                    return True
+                i = basename.find(".", i + 1)
+        return self.filetype_re is not None and bool(self.filetype_re.match(basename))
+
+    def __call__(self, path):
+        return (self.all_filetypes or self.filetype_ok(path)) and (
+            self.path_match_zero
+            or (
+                self.include_re is not None
+                and bool(self.include_re.match(path))
+                and not (self.exclude_re is not None and self.exclude_re.match(path))
+            )
+        )
 
 
 class MiniEntry:
-    def __init__(self, entry):
-        self.path = entry.path
-        self.binsha = entry.binsha
+    def __init__(self, path, binsha, old_path=None):
+        self.path = path
+        self.binsha = binsha
+        self.old_path = old_path  # Path it was renamed from, if it was changed too
 
 
 class MiniCommit:
-    def __init__(self, commit):
-        self.hexsha = commit.hexsha
-        self.committed_date = commit.committed_date
+    def __init__(self, hexsha, committed_date):
+        self.hexsha = hexsha
+        self.committed_date = committed_date
+
+
+class KeyIndex:
+    """Interns the keys of all curves, and the ("sha", hexsha) key of every commit, into integer ids.
+
+    This lets file histograms be stored as compact arrays of (key id, line count) pairs, and the
+    running totals as a single count vector indexed by key id. Ids are only ever appended, so
+    histograms saved by a previous incremental run stay valid.
+    """
+
+    def __init__(self):
+        self.key_ids = {}  # key tuple: id
+        self.commit_ids = {}  # binsha: (id of its sha key, id of its cohort key)
+        self.keys = []  # id: key tuple, or ("sha", binsha) for commits
+
+    def __len__(self):
+        return len(self.keys)
+
+    def add(self, key_tuple):
+        if key_tuple not in self.key_ids:
+            self.key_ids[key_tuple] = len(self.keys)
+            self.keys.append(key_tuple)
+        return self.key_ids[key_tuple]
+
+    def add_commit(self, binsha, cohort):
+        cohort_id = self.add(("cohort", cohort))
+        if binsha not in self.commit_ids:
+            self.commit_ids[binsha] = (len(self.keys), cohort_id)
+            self.keys.append(("sha", binsha))
+        return self.commit_ids[binsha][0]
+
+    def get_ids(self, key_tuples):
+        return numpy.array(
+            [self.key_ids[key_tuple] for key_tuple in key_tuples], dtype=numpy.int64
+        )
+
+    def sha_mask(self):
+        return numpy.array(
+            [key_tuple[0] == "sha" for key_tuple in self.keys], dtype=bool
+        )
+
+
+class CommitTable:
+    """Read-only lookup of the sha, cohort, author & domain key ids of every commit, by binsha.
+
+    Rows are sorted by binsha and saved to a temporary .npy file that every worker memory-maps, so
+    the table is kept in RAM only once no matter how many processes there are, and lookups are a
+    binary search. Only the file name is pickled when the workers are started.
+    """
+
+    def __init__(self, binshas, ids):
+        table = numpy.zeros(len(binshas), dtype=[("binsha", "S20"), ("ids", "i8", 4)])
+        table["binsha"] = binshas
+        table["ids"] = ids
+        table.sort(order="binsha")
+        fd, self.fn = tempfile.mkstemp(prefix="theseus_commits_", suffix=".npy")
+        with os.fdopen(fd, "wb") as f:
+            numpy.save(f, table)
+        self.table = None
+
+    def __getstate__(self):
+        return {"fn": self.fn, "table": None}
+
+    def get(self, binsha):
+        if self.table is None:
+            self.table = numpy.load(self.fn, mmap_mode="r")
+        binshas = self.table["binsha"]
+        key = binsha.rstrip(b"\0")  # NumPy strips trailing nulls from fixed-width bytes
+        i = numpy.searchsorted(binshas, key)
+        if i < len(binshas) and binshas[i] == key:
+            return tuple(self.table["ids"][i].tolist())
+        return None
+
+    def close(self):
+        try:
+            os.remove(self.fn)
+        except OSError:
+            pass  # Still mapped by a worker on Windows
 
 
 def get_top_dir(path):
@@ -71,121 +268,585 @@ def get_top_dir(path):
     )  # Git/GitPython on Windows also returns paths with '/'s
 
 
-class BlameProc(multiprocessing.Process):
+def get_path_keys(path):
+    _, ext = os.path.splitext(path)
+    return [("ext", ext), ("dir", get_top_dir(path))]
+
+
+def get_tree_changes(repo, prev_hexsha, hexsha, find_renames=False):
+    # Yields (path, binsha, None) of every file added or modified since `prev_hexsha`, and
+    # (path, None, None) of every deleted one. If there's no previous commit, every file of `hexsha`
+    # counts as added. With `find_renames`, renamed files (that may have changed too) are yielded
+    # as a deleted file, and an added one with the path it was renamed from
+    if prev_hexsha is None:
+        for record in repo.git.ls_tree(hexsha, r=True, z=True).split("\0"):
+            if not record:
+                continue
+            meta, path = record.split("\t", 1)
+            _, object_type, sha = meta.split()
+            if object_type == "blob":  # Skip submodules
+                yield path, bytes.fromhex(sha), None
+        return
+    fields = repo.git.diff_tree(
+        prev_hexsha,
+        hexsha,
+        r=True,
+        z=True,
+        **({"M": True} if find_renames else {"no_renames": True}),
+    )
+    fields = iter(
+        fields.split("\0")
+    )  # ":old_mode new_mode old_sha new_sha status", then the path, or old & new paths of renames
+    for meta in fields:
+        if not meta:
+            continue
+        _, new_mode, _, new_sha, status = meta.split()
+        old_path = None
+        if status.startswith("R"):
+            old_path = next(fields)
+            yield old_path, None, None
+        path = next(fields)
+        if status == "D" or new_mode == "160000":  # Deleted, or replaced by a submodule
+            yield path, None, None
+        else:
+            yield path, bytes.fromhex(new_sha), old_path
+
+
+def read_nul_separated(stream, chunk_size=64 * 1024):
+    rest = b""
+    for chunk in iter(lambda: stream.read(chunk_size), b""):
+        *records, rest = (rest + chunk).split(b"\0")
+        yield from records
+    if rest:
+        yield rest
+
+
+def iter_log(repo, n_fields, *args, **kwargs):
+    # Streams the `git log` of a format with `n_fields` NUL separated fields, as tuples of strings
+    proc = repo.git.log(*args, z=True, as_process=True, **kwargs)
+    records = (
+        record.decode("utf-8", "replace") for record in read_nul_separated(proc.stdout)
+    )
+    yield from zip(*[records] * n_fields)
+    proc.wait()
+
+
+def get_first_parent_churn(repo, path_ok):
+    # Yields (hexsha, committed date, lines added & deleted in the files that pass `path_ok`) of
+    # every commit on the first-parent chain of HEAD, newest first. One `git log` does all diffs
+    proc = repo.git.log(
+        "HEAD",
+        first_parent=True,
+        m=True,  # Diff merges against their first parent too
+        no_renames=True,
+        numstat=True,
+        z=True,
+        format="%x01%H %ct",
+        as_process=True,
+    )
+    hexsha = None
+    for record in read_nul_separated(proc.stdout):
+        record = record.lstrip(b"\n")
+        if record.startswith(b"\x01"):
+            if hexsha is not None:
+                yield hexsha, committed_date, churn
+            hexsha, committed_date = record[1:].decode().split()
+            committed_date, churn = int(committed_date), 0
+        elif record:
+            added, deleted, path = record.split(b"\t", 2)
+            if added != b"-" and path_ok(
+                path.decode("utf-8", "replace")
+            ):  # - if binary
+                churn += int(added) + int(deleted)
+    if hexsha is not None:
+        yield hexsha, committed_date, churn
+    proc.wait()
+
+
+# Matches the hunk headers of a `git diff -U0`, e.g. "@@ -12,3 +12,0 @@"
+HUNK_HEADER_RE = re.compile(r"^@@ -(\d+)(?:,(\d+))? \+(\d+)(?:,(\d+))? @@")
+
+
+def get_diff_hunks(diff):
+    hunks = []
+    for line in diff.splitlines():
+        m = HUNK_HEADER_RE.match(line)
+        if m:
+            a, b, c, d = m.groups()
+            hunks.append(
+                (int(a), 1 if b is None else int(b), int(c), 1 if d is None else int(d))
+            )
+    return hunks
+
+
+def splice_runs(runs, hunks):
+    # `runs` is a list of [hexsha, n_lines] in file order. Returns the runs of the new file, where
+    # lines introduced by `hunks` are marked with a `None` hexsha, and the (start, count) line
+    # ranges of the new file that have to be blamed
+    new_runs = []
+    new_ranges = []
+    old_runs = iter(runs)
+    pending = None  # Part of an old run not yet consumed
+
+    def take(n, keep):
+        nonlocal pending
+        while n > 0:
+            if pending is None:
+                pending = list(next(old_runs))
+            k = min(n, pending[1])
+            if keep:
+                append_run(new_runs, pending[0], k)
+            pending[1] -= k
+            n -= k
+            if pending[1] == 0:
+                pending = None
+
+    old_pos = 0
+    for old_start, old_count, new_start, new_count in hunks:
+        keep_until = old_start if old_count == 0 else old_start - 1
+        take(keep_until - old_pos, True)
+        take(old_count, False)
+        old_pos = keep_until + old_count
+        if new_count:
+            append_run(new_runs, None, new_count)
+            new_ranges.append((new_start, new_count))
+    if pending is not None:
+        append_run(new_runs, *pending)
+    for sha, n in old_runs:
+        append_run(new_runs, sha, n)
+    return new_runs, new_ranges
+
+
+def append_run(runs, hexsha, n):
+    if runs and runs[-1][0] == hexsha:
+        runs[-1][1] += n
+    elif n > 0:
+        runs.append([hexsha, n])
+
+
+class RepoBlamer:
+    """Blames the files of one repo, on behalf of a BlameDriver.
+
+    Workers of a BlamePool load it from a pickle the first time they get work for its repo, so a
+    pool can be shared between repos. The repo handle & per-commit caches are set up in the worker.
+    """
+
     def __init__(
-        self, repo_dir, q, ret_q, run_flag, blame_kwargs, commit2cohort, use_mailmap
+        self,
+        repo_dir,
+        blame_kwargs,
+        key_ids,
+        commit_table,
+        mailmap,
+        return_runs=False,
+        find_renames=False,
     ):
-        super().__init__(daemon=True)
-        self.repo: git.Repo = git.Repo(repo_dir)
-        self.q: multiprocessing.Queue = q
-        self.ret_q: multiprocessing.Queue = ret_q
-        self.run_flag: multiprocessing.Event = run_flag
+        self.repo_dir = repo_dir
         self.blame_kwargs = dict(blame_kwargs)
-        self.commit2cohort = commit2cohort  # On Unix systems if process is started via the `fork` method, could make this a copy-on-write variable to save RAM
-        self.use_mailmap = use_mailmap
+        self.key_ids = key_ids  # Ids of the cohort, author & domain keys, small enough to copy to each worker
+        self.commit_table = commit_table
+        self.mailmap = mailmap  # (name, email): mailmapped (name, email) of the branch's authors, None without a .mailmap
+        self.return_runs = return_runs
+        self.find_renames = (
+            find_renames  # Also pair up files that were renamed & changed
+        )
+        self.repo = None
+        self.spawn_stats = None
+        self.commit_authors = {}  # hexsha: (binsha, author name, author email)
+        self.commit_keys = (
+            {}
+        )  # hexsha: ids of the cohort, author, domain & sha keys of a commit
+        self.bytes_read = 0  # Output of all git processes started
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state.update(repo=None, spawn_stats=None, commit_authors={}, commit_keys={})
+        return state
+
+    def start(self, spawn_stats):
+        self.repo = git.Repo(self.repo_dir)
+        self.spawn_stats = spawn_stats  # Shared between all workers
+
+    def spawn_git(self, method, *args, **kwargs):
+        # Blame & diff need a git process of their own, keep track of what it costs to start them
+        start = time.perf_counter()
+        proc = method(*args, as_process=True, **kwargs)
+        spawn_count, spawn_time = self.spawn_stats
+        with spawn_count.get_lock():
+            spawn_count.value += 1
+            spawn_time.value += time.perf_counter() - start
+        return proc
+
+    def blame_runs(self, path, commit, **kwargs):
+        # Stream `git blame --incremental`, which prints one entry per blamed line range (in no
+        # particular order) and the author of each commit only the first time it shows up
+        proc = self.spawn_git(
+            self.repo.git.blame,
+            commit,
+            "--",
+            path,
+            incremental=True,
+            **self.blame_kwargs,
+            **kwargs,
+        )
+        line_ranges = []
+        hexsha = None
+        for line in proc.stdout:
+            self.bytes_read += len(line)
+            if hexsha is None:
+                hexsha, _, final_line, n = line.split()
+                hexsha = hexsha.decode()
+                line_ranges.append((int(final_line), hexsha, int(n)))
+            elif line.startswith(b"author "):
+                author_name = line[7:].rstrip(b"\n").decode("utf-8", "replace")
+            elif line.startswith(b"author-mail "):
+                author_email = line[12:].rstrip(b"\n").decode("utf-8", "replace")
+                author_email = author_email.lstrip("<").rstrip(">")
+            elif line.startswith(b"filename "):
+                if hexsha not in self.commit_authors:
+                    self.commit_authors[hexsha] = (
+                        bytes.fromhex(hexsha),
+                        author_name,
+                        author_email,
+                    )
+                hexsha = None
+        proc.wait()
+
+        runs = []
+        for _, hexsha, n in sorted(line_ranges):
+            append_run(runs, hexsha, n)
+        return runs
+
+    # Only blame the lines that changed since `prev_commit`, carrying forward the attribution of the
+    # rest. Renamed files are diffed against their old path
+    def reblame_runs(self, path, commit, prev_commit, prev_runs, prev_path=None):
+        diff_args = (
+            [prev_commit, commit, "--", path]
+            if prev_path is None
+            else ["%s:%s" % (prev_commit, prev_path), "%s:%s" % (commit, path)]
+        )
+        proc = self.spawn_git(
+            self.repo.git.diff,
+            *diff_args,
+            unified=0,  # U=0 would be dropped, GitPython skips options that are 0
+            text=True,
+            no_ext_diff=True,
+            no_color=True,
+            **self.blame_kwargs,
+        )
+        diff = proc.stdout.read()
+        self.bytes_read += len(diff)
+        diff = diff.decode("utf-8", "replace")
+        proc.wait()
+        runs, new_ranges = splice_runs(prev_runs, get_diff_hunks(diff))
+        if not new_ranges:
+            return runs
+        new_lines = iter(
+            self.blame_runs(
+                path, commit, L=["%d,+%d" % new_range for new_range in new_ranges]
+            )
+        )
+        blamed = []
+        pending = None
+        for sha, n in runs:
+            if sha is not None:
+                append_run(blamed, sha, n)
+                continue
+            while n > 0:
+                if pending is None:
+                    pending = list(next(new_lines))
+                k = min(n, pending[1])
+                append_run(blamed, pending[0], k)
+                pending[1] -= k
+                n -= k
+                if pending[1] == 0:
+                    pending = None
+        if pending is not None or next(new_lines, None) is not None:
+            raise ValueError("Blamed line count does not match the diff of %s" % path)
+        return blamed
+
+    def get_commit_author(self, hexsha):
+        if hexsha not in self.commit_authors:
+            commit = self.repo.commit(hexsha)
+            self.commit_authors[hexsha] = (
+                commit.binsha,
+                commit.author.name,
+                commit.author.email,
+            )
+        return self.commit_authors[hexsha]
+
+    def get_commit_keys(self, hexsha):
+        if hexsha not in self.commit_keys:
+            ids = self.commit_table.get(bytes.fromhex(hexsha))
+            if ids is None:  # Not on the analyzed branch
+                _, author_name, author_email = self.get_commit_author(hexsha)
+                if self.mailmap is not None:
+                    author_name, author_email = self.mailmap.get(
+                        (author_name, author_email)
+                    ) or get_mailmap_author_name_email(
+                        self.repo, author_name, author_email
+                    )
+                ids = (
+                    self.key_ids.get(("cohort", "MISSING")),
+                    self.key_ids.get(("author", author_name)),
+                    self.key_ids.get(("domain", author_email.split("@")[-1])),
+                )
+            # Keys that aren't tracked by any curve can be dropped right away
+            self.commit_keys[hexsha] = tuple(i for i in ids if i is not None)
+        return self.commit_keys[hexsha]
 
-    # Get Blame data for a `file` at `commit`
-    def get_file_histogram(self, path, commit):
+    # Get Blame data for a `file` at `commit`, as an array of (key id, line count) pairs, and its
+    # line count. Its ext & dir keys are added by the driver, as they show up while blaming
+    def get_file_histogram(self, path, commit, size, prev=None, cached=None):
         h = {}
+        runs = None
+        total = 0
         try:
-            for old_commit, lines in self.repo.blame(commit, path, **self.blame_kwargs):
-                cohort = self.commit2cohort.get(old_commit.binsha, "MISSING")
-                _, ext = os.path.splitext(path)
-                if self.use_mailmap:
-                    author_name, author_email = get_mailmap_author_name_email(
-                        self.repo, old_commit.author.name, old_commit.author.email
-                    )
-                else:
-                    author_name, author_email = (
-                        old_commit.author.name,
-                        old_commit.author.email,
+            if cached is not None:
+                blamed = []
+                for hexsha, n, author_name, author_email in cached:
+                    self.commit_authors.setdefault(
+                        hexsha, (bytes.fromhex(hexsha), author_name, author_email)
                     )
-                keys = [
-                    ("cohort", cohort),
-                    ("ext", ext),
-                    ("author", author_name),
-                    ("dir", get_top_dir(path)),
-                    ("domain", author_email.split("@")[-1]),
+                    blamed.append([hexsha, n])
+            elif size == 0:
+                blamed = []  # No need to start a blame process for these
+            elif prev is not None:
+                try:
+                    blamed = self.reblame_runs(path, commit, *prev)
+                except Exception:
+                    blamed = self.blame_runs(path, commit)  # Fall back to a full blame
+            else:
+                blamed = self.blame_runs(path, commit)
+
+            for hexsha, n in blamed:
+                for key_id in self.get_commit_keys(hexsha):
+                    h[key_id] = h.get(key_id, 0) + n
+                total += n
+            runs = blamed
+        except:
+            pass
+        return (
+            numpy.array([list(h.keys()), list(h.values())], dtype=numpy.int32).reshape(
+                2, -1
+            ),
+            runs,
+            total,
+        )
+
+    def blame_chunk(self, commit, chunk):
+        results = []
+        for entry, size, prev, cached in chunk:
+            start, bytes_read = time.perf_counter(), self.bytes_read
+            h, runs, total = self.get_file_histogram(entry, commit, size, prev, cached)
+            if self.return_runs and runs is not None:
+                runs = [
+                    [hexsha, n, *self.get_commit_author(hexsha)[1:]]
+                    for hexsha, n in runs
                 ]
+            else:
+                runs = None
+            results.append(
+                (
+                    entry,
+                    h,
+                    total,
+                    runs,
+                    time.perf_counter() - start,
+                    self.bytes_read - bytes_read,
+                )
+            )
+        return results
 
-                if old_commit.binsha in self.commit2cohort:
-                    keys.append(("sha", old_commit.hexsha))
+    def diff_trees(self, pairs):
+        # Files changed between each (previous hexsha, hexsha) pair of a range of sampled commits
+        return [
+            list(get_tree_changes(self.repo, prev_hexsha, hexsha, self.find_renames))
+            for prev_hexsha, hexsha in pairs
+        ]
 
-                for key in keys:
-                    h[key] = h.get(key, 0) + len(lines)
-        except:
-            pass
-        return h
+
+class BlameWorkerError(Exception):
+    """Raised by a BlameDriver when a worker failed at some of its work, with the worker's traceback."""
+
+
+# Max number of repos a worker keeps a RepoBlamer of at once
+MAX_WORKER_BLAMERS = 8
+
+
+class BlameProc(multiprocessing.Process):
+    def __init__(self, q, ret_q, run_flag, spawn_stats, worker_stats, profile_dir=None):
+        super().__init__(daemon=True)
+        self.q: multiprocessing.Queue = q
+        self.ret_q: multiprocessing.Queue = ret_q
+        self.run_flag: multiprocessing.Event = run_flag
+        self.spawn_stats = spawn_stats
+        self.worker_stats = worker_stats
+        self.profile_dir = profile_dir
+        self.blamers = (
+            collections.OrderedDict()
+        )  # Pickle file name: RepoBlamer, least recently used first
+
+    def get_blamer(self, blamer_fn):
+        if blamer_fn in self.blamers:
+            self.blamers.move_to_end(blamer_fn)
+        else:
+            with open(blamer_fn, "rb") as f:
+                blamer = pickle.load(f)
+            blamer.start(self.spawn_stats)
+            self.blamers[blamer_fn] = blamer
+            if len(self.blamers) > MAX_WORKER_BLAMERS:
+                self.blamers.popitem(last=False)
+        return self.blamers[blamer_fn]
 
     def run(self):
         signal.signal(signal.SIGINT, signal.SIG_IGN)
+        profiler = None
+        if self.profile_dir is not None:
+            profiler = cProfile.Profile()
+            profiler.enable()
+        idle_time, busy_time = self.worker_stats
         try:
             while self.run_flag.wait():
-                entry, commit = self.q.get()
-                if not commit:
+                start = time.perf_counter()
+                blamer_fn, idx, method, args = self.q.get()
+                got = time.perf_counter()
+                if method is None:
                     return
-                self.ret_q.put((entry, self.get_file_histogram(entry, commit)))
-        except:
-            raise
-
-
-class BlameDriver:
-    def __init__(
-        self,
-        repo_dir,
-        proc_count,
-        last_file_y,
-        cur_y,
-        blame_kwargs,
-        commit2cohort,
-        use_mailmap,
-        quiet,
-    ):
-        self.repo_dir = repo_dir
+                if not os.path.exists(blamer_fn):
+                    # Its driver was closed, e.g. as its analysis failed, and nobody waits for this
+                    self.blamers.pop(blamer_fn, None)
+                    continue
+                try:
+                    results = getattr(self.get_blamer(blamer_fn), method)(*args)
+                except Exception:
+                    # Sent back to the driver, which would otherwise wait for the results forever
+                    results = BlameWorkerError(traceback.format_exc())
+                self.ret_q.put((blamer_fn, idx, results))
+                with idle_time.get_lock():
+                    idle_time.value += got - start
+                with busy_time.get_lock():
+                    busy_time.value += time.perf_counter() - got
+        finally:
+            if profiler is not None:
+                profiler.disable()
+                profiler.dump_stats(os.path.join(self.profile_dir, self.name + ".prof"))
+
+
+# Files are sent to the workers in chunks of up to this many files / bytes, to save on IPC round-trips
+CHUNK_MAX_ENTRIES = 64
+CHUNK_MAX_BYTES = 64 * 1024
+
+
+def chunk_entries(entries, sizes, n_chunks=1):
+    # Biggest files go first, so a huge file doesn't hold up everyone else at the end of a commit.
+    # Sorting by size also means big files end up in chunks of their own, and small ones get batched.
+    # Files are spread over at least `n_chunks` chunks if there are enough, so every worker gets some
+    max_entries = min(CHUNK_MAX_ENTRIES, -(-len(entries) // n_chunks))
+    max_bytes = min(CHUNK_MAX_BYTES, -(-sum(sizes) // n_chunks))
+    chunks = []
+    chunk, chunk_bytes = [], 0
+    for size, item in sorted(zip(sizes, entries), key=lambda x: -x[0]):
+        if chunk and (len(chunk) >= max_entries or chunk_bytes + size > max_bytes):
+            chunks.append(chunk)
+            chunk, chunk_bytes = [], 0
+        chunk.append(item)
+        chunk_bytes += size
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+
+class BlamePool:
+    """Blame worker processes, shared by the BlameDrivers of one or more repos.
+
+    Every driver registers a RepoBlamer, and its work & results are tagged with it. A thread routes
+    the results coming back from the workers to the driver they belong to. Once a driver is closed,
+    the workers skip whatever work of it is still queued up.
+    """
+
+    def __init__(self, proc_count, quiet, profile_dir=None):
         self.proc_count = proc_count
+        self.quiet = quiet
+        self.profile_dir = (
+            profile_dir  # Workers write a cProfile dump there when they exit
+        )
         self.q = multiprocessing.Queue()
         self.ret_q = multiprocessing.Queue()
         self.run_flag = multiprocessing.Event()
         self.run_flag.set()
-        self.last_file_y = last_file_y
-        self.cur_y = cur_y
-        self.blame_kwargs = blame_kwargs
-        self.commit2cohort = commit2cohort
-        self.use_mailmap = use_mailmap
-        self.quiet = quiet
+        self.spawn_stats = (
+            multiprocessing.Value("l"),
+            multiprocessing.Value("d"),
+        )  # Number of git processes started by the workers, and the time it took
+        self.worker_stats = (
+            multiprocessing.Value("d"),
+            multiprocessing.Value("d"),
+        )  # Time the workers spent waiting for work, and working
+        self.tmp_dir = tempfile.mkdtemp(prefix="theseus_")
+        self.blamer_ids = itertools.count()
+        self.driver_qs = (
+            {}
+        )  # RepoBlamer pickle file name: queue of results for its driver
+        self.lock = (
+            threading.Lock()
+        )  # Drivers of several repos can run in different threads
         self.proc_pool = []
-        self.spawn_process(self.proc_count)
+        self.spawn_process()
+        threading.Thread(target=self.route_results, daemon=True).start()
+
+    def add_blamer(self, blamer):
+        blamer_fn = os.path.join(
+            self.tmp_dir, "blamer_{:d}.pickle".format(next(self.blamer_ids))
+        )
+        with open(blamer_fn, "wb") as f:
+            pickle.dump(blamer, f)
+        self.driver_qs[blamer_fn] = queue.Queue()
+        return blamer_fn, self.driver_qs[blamer_fn]
+
+    def remove_blamer(self, blamer_fn):
+        if self.driver_qs.pop(blamer_fn, None) is not None:
+            os.remove(blamer_fn)
+
+    def route_results(self):
+        while True:
+            blamer_fn, idx, results = self.ret_q.get()
+            driver_q = self.driver_qs.get(blamer_fn)
+            if driver_q is not None:  # Results of closed drivers are dropped
+                driver_q.put((idx, results))
 
     def spawn_process(self, spawn_only=False):
-        n = self.proc_count - len(self.proc_pool)
-        if n == 0:
-            return
-        if n < 0:
-            return None if spawn_only else self._despawn_process(-n)
-        if not self.quiet:
-            print("\n\nStarting up processes: ", end="")
-        for i in range(n):
-            self.proc_pool.append(
-                BlameProc(
-                    self.repo_dir,
-                    self.q,
-                    self.ret_q,
-                    self.run_flag,
-                    self.blame_kwargs,
-                    self.commit2cohort,
-                    self.use_mailmap,
-                )
-            )
-            self.proc_pool[-1].start()
+        with self.lock:
+            n = self.proc_count - len(self.proc_pool)
+            if n == 0:
+                return
+            if n < 0:
+                return None if spawn_only else self._despawn_process(-n)
             if not self.quiet:
-                print(
-                    ("" if i == 0 else ", ") + self.proc_pool[-1].name,
-                    end="\n" if i == n - 1 else "",
+                print("\n\nStarting up processes: ", end="")
+            gc.freeze()  # Keeps forked workers from touching (and so copying) the parent's objects
+            for i in range(n):
+                self.proc_pool.append(
+                    BlameProc(
+                        self.q,
+                        self.ret_q,
+                        self.run_flag,
+                        self.spawn_stats,
+                        self.worker_stats,
+                        self.profile_dir,
+                    )
                 )
+                self.proc_pool[-1].start()
+                if not self.quiet:
+                    print(
+                        ("" if i == 0 else ", ") + self.proc_pool[-1].name,
+                        end="\n" if i == n - 1 else "",
+                    )
+            gc.unfreeze()
 
     def _despawn_process(self, n):
         for i in range(n):
-            self.q.put((None, None))
+            self.q.put((None, None, None, None))
 
         print("\n")
         while True:
@@ -207,32 +868,283 @@ class BlameDriver:
                 self.proc_pool = [proc for proc in self.proc_pool if proc.is_alive()]
                 return
 
-    def fetch(self, commit, check_entries, bar):
-        self.spawn_process()
-        processed_entries = 0
-        total_entries = len(check_entries)
+    def pause(self):
+        self.run_flag.clear()
+
+    def resume(self):
+        self.run_flag.set()
+
+    def close(self, terminate=False):
+        # Terminated workers don't get to the work that's still queued up
+        for proc in self.proc_pool:
+            if terminate:
+                proc.terminate()
+            else:
+                self.q.put((None, None, None, None))
+        for proc in self.proc_pool:
+            proc.join()
+        self.proc_pool = []
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
 
-        for entry in check_entries:
-            self.q.put((entry.path, commit.hexsha))
 
-        while processed_entries < total_entries:
-            path, file_y = self.ret_q.get()
+# Sampled commits are diffed by the workers in ranges of up to this many commits
+DISCOVER_RANGE_COMMITS = 16
 
-            for key_tuple, file_locs in file_y.items():
-                self.cur_y[key_tuple] = self.cur_y.get(key_tuple, 0) + file_locs
-            self.last_file_y[path] = file_y
+# Sampled commits in flight at once by default, with few processes
+MIN_PIPELINE_DEPTH = 4
 
-            processed_entries += 1
-            self.run_flag.wait()
-            bar.update()
+# Upper bounds of the buckets of the histogram of blame times per file, in seconds
+BLAME_SECONDS_BUCKETS = [0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 60]
 
+
+class BlameDriver:
+    def __init__(
+        self,
+        pool,
+        repo_dir,
+        key_ids,
+        last_file_y,
+        cur_y,
+        seen_keys,
+        blamer,
+        last_file_runs=None,
+        cache=None,
+    ):
+        self.pool = pool
+        self.repo = git.Repo(repo_dir)  # Only used to look up blob sizes
+        self.blamer_fn, self.ret_q = pool.add_blamer(blamer)
+        self.key_ids = key_ids  # Ext & dir keys get added along the way
+        self.last_file_y = last_file_y
+        self.cur_y = cur_y
+        self.seen_keys = seen_keys
+        self.last_file_runs = last_file_runs  # Blame runs of each file when it was last seen, only kept for incremental blames
+        self.cache = cache
+        self.in_flight = (
+            {}
+        )  # Index of each submitted commit: (hexsha, number of files, paths found in the cache)
+        self.results = {}  # Index of each submitted commit: results received so far
+        self.changes = (
+            {}
+        )  # Index of each discovered commit: files changed since the one before
+        self.blamed_entries = 0
+        self.moved_entries = 0  # Renamed files that didn't have to be blamed
+        self.chunks_sent = 0
+        self.results_received = 0  # Messages, each one has the results of a chunk
+        self.blob_bytes = 0  # Size of all files sent to be blamed
+        self.git_bytes_read = 0
+        self.blame_seconds = numpy.zeros(
+            len(BLAME_SECONDS_BUCKETS) + 1, dtype=numpy.int64
+        )  # Histogram of the time it took to blame each file
+        self.blame_seconds_sum = 0.0
+
+    def discover(self, start, pairs):
+        # Have a worker diff the trees of a range of sampled commits, the first one at index `start`
+        self.pool.q.put((self.blamer_fn, ("diff", start), "diff_trees", (pairs,)))
+
+    # Wait for the files changed at a discovered commit, taking in the blames that come in meanwhile
+    def get_changes(self, idx, bar):
+        while idx not in self.changes:
+            self.receive(bar)
+            self.pool.run_flag.wait()
+        return self.changes.pop(idx)
+
+    def receive(self, bar):
+        result_idx, results = self.ret_q.get()
+        if isinstance(results, BlameWorkerError):
+            raise results
+        if isinstance(result_idx, tuple):  # Tree diffs of a range of commits
+            for idx, changes in enumerate(results, result_idx[1]):
+                self.changes[idx] = changes
+            return
+        self.results[result_idx].extend(results)
+        self.results_received += 1
+        bar.update(len(results))
+
+    def submit(self, idx, commit, check_entries):
+        # Queue up the blames of a commit without waiting for the commits before it to finish.
+        # With incremental blames, files still in flight are reblamed from an older commit
+        cached_paths = set()
+        items, sizes = [], []
+        for entry in check_entries:
+            prev, cached = None, None
+            if self.cache is not None:
+                cached = self.cache.get(commit.hexsha, entry.path)
+                if cached is not None:
+                    cached_paths.add(entry.path)
+            if self.last_file_runs is not None:
+                if entry.path in self.last_file_runs:
+                    prev = self.last_file_runs[entry.path]
+                elif entry.old_path in self.last_file_runs:  # Renamed & changed
+                    prev = (*self.last_file_runs[entry.old_path], entry.old_path)
+            # Cached files don't need to be blamed, so they're cheap no matter their size
+            size = 0 if cached is not None else self.repo.odb.info(entry.binsha).size
+            items.append((entry.path, size, prev, cached))
+            sizes.append(size)
+        self.blob_bytes += sum(sizes)
+        for chunk in chunk_entries(items, sizes, max(self.pool.proc_count, 1)):
+            self.pool.q.put(
+                (self.blamer_fn, idx, "blame_chunk", (commit.hexsha, chunk))
+            )
+            self.chunks_sent += 1
+        self.in_flight[idx] = (commit.hexsha, len(check_entries), cached_paths)
+        self.results[idx] = []
+
+    # Wait for all blames of a submitted commit, and add them to cur_y & last_file_y. Commits have
+    # to be fetched in the order they were submitted
+    def fetch(self, idx, bar):
+        self.pool.spawn_process()
+        hexsha, total_entries, cached_paths = self.in_flight.pop(idx)
+        while len(self.results[idx]) < total_entries:
+            self.receive(bar)
+            self.pool.run_flag.wait()
+        self.blamed_entries += total_entries
+
+        for path, file_y, total, runs, seconds, bytes_read in self.results.pop(idx):
+            self.add_result(hexsha, path, file_y, total, runs, cached_paths)
+            self.blame_seconds[bisect.bisect_left(BLAME_SECONDS_BUCKETS, seconds)] += 1
+            self.blame_seconds_sum += seconds
+            self.git_bytes_read += bytes_read
+        if self.cache is not None:
+            self.cache.commit()
         return self.cur_y
 
-    def pause(self):
-        self.run_flag.clear()
+    def add_file_y(self, path, file_y, total):
+        if total:  # All lines of a file count towards its ext & dir
+            path_key_ids = [
+                self.key_ids[key_tuple] for key_tuple in get_path_keys(path)
+            ]
+            file_y = numpy.hstack(
+                [file_y, numpy.array([path_key_ids, [total] * 2], dtype=numpy.int32)]
+            )
+        key_ids, counts = file_y
+        self.cur_y[key_ids] += counts
+        self.seen_keys[key_ids] = True
+        self.last_file_y[path] = file_y
+
+    def add_result(self, hexsha, path, file_y, total, runs, cached_paths):
+        self.add_file_y(path, file_y, total)
+        if runs is not None:
+            if self.cache is not None and path not in cached_paths:
+                self.cache.put(hexsha, path, runs)
+            if self.last_file_runs is not None:
+                self.last_file_runs[path] = (
+                    hexsha,
+                    [run[:2] for run in runs],
+                )
+        elif self.last_file_runs is not None:
+            self.last_file_runs.pop(path, None)
+
+    # A file that was renamed without changes keeps its blame, only its ext & dir keys change. Git
+    # blame follows renames, so it comes up with the same attribution for actual renames, but not
+    # for a copy whose original was deleted later, or a file that was deleted & added back later on
+    def move(self, hexsha, old_path, path):
+        file_y = self.last_file_y[old_path]
+        key_ids, counts = file_y
+        is_path_key = numpy.isin(
+            key_ids, [self.key_ids[key_tuple] for key_tuple in get_path_keys(old_path)]
+        )
+        self.add_file_y(
+            path, file_y[:, ~is_path_key], int(counts[is_path_key].max(initial=0))
+        )
+        self.moved_entries += 1
+        if self.last_file_runs is not None and old_path in self.last_file_runs:
+            self.last_file_runs[path] = (hexsha, self.last_file_runs[old_path][1])
 
-    def resume(self):
-        self.run_flag.set()
+    def close(self):
+        self.pool.remove_blamer(self.blamer_fn)
+
+
+def dump_results(
+    outdir, ts, curves, curve_key_tuples, commit_history, npz=False, quiet=False
+):
+    def dump_json(output_fn, key_type, label_fmt=lambda x: x):
+        key_items = sorted(k for t, k in curve_key_tuples if t == key_type)
+        fn = os.path.join(outdir, output_fn)
+        if not quiet:
+            print("Writing %s data to %s" % (key_type, fn))
+        # Written one curve at a time, so they don't all have to be in RAM as lists at once
+        f = open(fn, "w")
+        f.write('{"y": [')
+        for i, key_item in enumerate(key_items):
+            f.write(", " if i else "")
+            json.dump(curves[(key_type, key_item)], f)
+        f.write('], "ts": ')
+        json.dump([t.isoformat() for t in ts], f)
+        f.write(', "labels": ')
+        json.dump([label_fmt(key_item) for key_item in key_items], f)
+        f.write("}")
+        f.close()
+
+    # Same data as dump_json, as a (label, time) count matrix, timestamps & labels. Left uncompressed,
+    # so the plotting tools can memory-map it
+    def dump_npz(output_fn, key_type, label_fmt=lambda x: x):
+        key_items = sorted(k for t, k in curve_key_tuples if t == key_type)
+        fn = os.path.join(outdir, output_fn)
+        if not quiet:
+            print("Writing %s data to %s" % (key_type, fn))
+        y = numpy.array(
+            [curves[(key_type, key_item)] for key_item in key_items], dtype=numpy.int64
+        ).reshape(len(key_items), len(ts))
+        numpy.savez(
+            fn,
+            y=y.astype(numpy.int32) if y.size == 0 or y.max() < 2**31 else y,
+            ts=numpy.array(ts, dtype="datetime64[s]"),
+            labels=numpy.array(
+                [label_fmt(key_item) for key_item in key_items], dtype=str
+            ),
+        )
+
+    # Dump accumulated stuff
+    for dump, ext in [(dump_json, ".json")] + ([(dump_npz, ".npz")] if npz else []):
+        dump("cohorts" + ext, "cohort", lambda c: "Code added in %s" % c)
+        dump("exts" + ext, "ext")
+        dump("authors" + ext, "author")
+        dump("dirs" + ext, "dir")
+        dump("domains" + ext, "domain")
+
+    # Dump survival data. Commits only have an entry when their line count changed, and every
+    # commit is tracked at all analyzed times from its first entry on
+    sample_ts = [calendar.timegm(t.timetuple()) for t in ts]
+    fn = os.path.join(outdir, "survival.json")
+    f = open(fn, "w")
+    if not quiet:
+        print("Writing survival data to %s" % fn)
+    f.write('{"ts": ')
+    json.dump(sample_ts, f)
+    f.write(', "commits": {')
+    for i, (hexsha, history) in enumerate(commit_history.items()):
+        f.write(", " if i else "")
+        f.write(json.dumps(hexsha) + ": ")
+        json.dump(history, f)
+    f.write("}}")
+    f.close()
+    if npz:
+        # The histories of all commits are concatenated, commit i's is at offsets[i]:offsets[i + 1]
+        fn = os.path.join(outdir, "survival.npz")
+        if not quiet:
+            print("Writing survival data to %s" % fn)
+        if isinstance(commit_history, HistorySpill):
+            hexshas, offsets, history_ts, counts = commit_history.arrays()
+        else:
+            hexshas = list(commit_history.keys())
+            histories = list(commit_history.values())
+            pairs = numpy.array(
+                [pair for history in histories for pair in history], dtype=numpy.int64
+            ).reshape(-1, 2)
+            offsets = numpy.cumsum([0] + [len(history) for history in histories])
+            history_ts, counts = pairs[:, 0], pairs[:, 1]
+        numpy.savez(
+            fn,
+            sample_ts=numpy.array(sample_ts, dtype=numpy.int64),
+            commits=numpy.array(hexshas, dtype="S40"),
+            offsets=offsets,
+            ts=history_ts,
+            counts=(
+                counts.astype(numpy.int32)
+                if counts.size == 0 or counts.max() < 2**31
+                else counts
+            ),
+        )
 
 
 def analyze(
@@ -248,6 +1160,19 @@ def analyze(
     procs=2,
     quiet=False,
     opt=False,
+    pipeline_depth=None,
+    incremental_blame=False,
+    cache=False,
+    cache_size=512,
+    incremental=False,
+    npz=False,
+    pool=None,
+    shard=None,
+    metrics=None,
+    profile=None,
+    adaptive_samples=None,
+    max_memory=None,
+    find_renames=False,
 ):
     use_mailmap = (Path(repo_dir) / ".mailmap").exists()
     repo = git.Repo(repo_dir)
@@ -255,17 +1180,86 @@ def analyze(
     if ignore_whitespace:
         blame_kwargs["w"] = True
     master_commits = []  # only stores a subset
-    commit2cohort = {}
     curve_key_tuples = set()  # Keys of each curve that will be tracked
     tqdm_args = {
         "smoothing": 0.025,  # Exponential smoothing is still rather jumpy, a tiny number will do
         "disable": quiet,
         "dynamic_ncols": True,
     }
+    profiler = None
+    if profile is not None:
+        if not os.path.exists(profile):
+            os.makedirs(profile)
+        profiler = cProfile.Profile()
+        profiler.enable()
+    phase_seconds = {}  # Wall time of each phase of the analysis
+    phase_start = time.perf_counter()
+
+    def end_phase(phase):
+        nonlocal phase_start
+        now = time.perf_counter()
+        phase_seconds[phase] = now - phase_start
+        phase_start = now
+
+    def finish(stats):
+        stats["phase_seconds"] = phase_seconds
+        stats["peak_rss_mb"] = get_peak_rss_mb()
+        if metrics is not None:
+            if not quiet:
+                print("Writing metrics to %s" % metrics)
+            write_metrics(metrics, stats, repo_dir)
+        if profiler is not None:
+            profiler.disable()
+            fn = os.path.join(profile, "main.prof")
+            if not quiet:
+                print("Writing profile to %s" % fn)
+            profiler.dump_stats(fn)
+        return stats
+
+    if shard is not None:
+        if incremental:
+            raise ValueError("Sharded runs can't be incremental")
+        if not 1 <= shard[0] <= shard[1]:
+            raise ValueError("Invalid shard {:d} of {:d}".format(*shard))
+    if max_memory is not None and (incremental or shard is not None):
+        raise ValueError(
+            "Runs with a memory limit can't be incremental or sharded, they need all results in RAM"
+        )
 
     if not os.path.exists(outdir):
         os.makedirs(outdir)
 
+    # Settings that have to stay the same between incremental runs
+    settings = {
+        "cohortfm": cohortfm,
+        "ignore": ignore,
+        "only": only,
+        "branch": branch,
+        "all_filetypes": all_filetypes,
+        "ignore_whitespace": ignore_whitespace,
+        "incremental_blame": incremental_blame,
+        "find_renames": find_renames,
+    }
+    state = None
+    state_fn = os.path.join(outdir, "state.pickle")
+    if incremental and os.path.exists(state_fn):
+        with open(state_fn, "rb") as f:
+            state = pickle.load(f)
+        if state["settings"] != settings:
+            warnings.warn(
+                "Settings changed since the last incremental run in {:s}, analyzing the full history".format(
+                    outdir
+                )
+            )
+            state = None
+        elif not repo.is_ancestor(state["last_commit"].hexsha, repo.head.commit):
+            warnings.warn(
+                "Last analyzed commit {:s} is not an ancestor of HEAD anymore, analyzing the full history".format(
+                    state["last_commit"].hexsha
+                )
+            )
+            state = None
+
     # Check if specified branch exists
     try:
         repo.git.show_ref("refs/heads/{:s}".format(branch), verify=True)
@@ -295,253 +1289,583 @@ def analyze(
             ["git", "commit-graph", "write", "--changed-paths"]
         )  # repo.git.commit_graph('write --changed-paths') doesn't work for some reason
 
+    key_index = state["key_index"] if state is not None else KeyIndex()
+    commit_binshas = []
+    commit_authors = []  # Index in authors of the author of each commit
+    authors = {}  # (name, email): index, as in the commits
     desc = "{:<55s}".format("Listing all commits")
-    for commit in tqdm(
-        repo.iter_commits(branch), desc=desc, unit=" Commits", **tqdm_args
+    for hexsha, committed_date, author_name, author_email in tqdm(
+        iter_log(repo, 4, branch, "--", format="%H%x00%ct%x00%an%x00%ae"),
+        desc=desc,
+        unit=" Commits",
+        **tqdm_args,
     ):
-        cohort = datetime.datetime.utcfromtimestamp(commit.committed_date).strftime(
+        binsha = bytes.fromhex(hexsha)
+        cohort = datetime.datetime.utcfromtimestamp(int(committed_date)).strftime(
             cohortfm
         )
-        commit2cohort[commit.binsha] = cohort
+        key_index.add_commit(binsha, cohort)
         curve_key_tuples.add(("cohort", cohort))
-        if use_mailmap:
-            author_name, author_email = get_mailmap_author_name_email(
-                repo, commit.author.name, commit.author.email
-            )
-        else:
-            author_name, author_email = commit.author.name, commit.author.email
-        curve_key_tuples.add(("author", author_name))
-        curve_key_tuples.add(("domain", author_email.split("@")[-1]))
+        commit_binshas.append(binsha)
+        commit_authors.append(
+            authors.setdefault((author_name, author_email), len(authors))
+        )
+
+    # All authors are mailmapped at once, which is a lot faster than one by one
+    mailmap = get_mailmap_authors(repo, list(authors)) if use_mailmap else None
+    author_keys = []  # (author key, domain key) of each author
+    for author in authors:
+        author_name, author_email = mailmap[author] if use_mailmap else author
+        author_key = ("author", author_name)
+        domain_key = ("domain", author_email.split("@")[-1])
+        curve_key_tuples.add(author_key)
+        curve_key_tuples.add(domain_key)
+        author_keys.append((author_key, domain_key))
+    del authors
+
+    end_phase("list_commits")
+
+    path_filter = PathFilter(
+        only, ignore, all_filetypes, [] if all_filetypes else get_default_filetypes()
+    )
 
     desc = "{:<55s}".format("Backtracking the master branch")
     with tqdm(desc=desc, unit=" Commits", **tqdm_args) as bar:
-        commit = repo.head.commit
-        last_date = None
-        while True:
-            if last_date is None or commit.committed_date < last_date - interval:
-                master_commits.append(commit)
-                last_date = commit.committed_date
-            bar.update()
-            if not commit.parents:
-                break
-            commit = commit.parents[0]
-        del commit
-
-    if ignore and not only:
-        only = ["**"]  # stupid fix
-    def_ft_str = "+({:s})".format("|".join(default_filetypes))
-    path_match_str = "{:s}|!+({:s})".format("|".join(only), "|".join(ignore))
-    path_match_zero = len(only) == 0 and len(ignore) == 0
-    ok_entry_paths = dict()
-    all_entries = []
-
-    def entry_path_ok(path):
-        # All this matching is slow so let's cache it
-        if path not in ok_entry_paths:
-            ok_entry_paths[path] = (
-                all_filetypes
-                or fnmatch.fnmatch(
-                    os.path.split(path)[-1], def_ft_str, flags=fnmatch.EXTMATCH
+        if adaptive_samples:
+            chain = (
+                []
+            )  # (hexsha, committed date, lines changed) of each commit, newest first
+            for hexsha, committed_date, churn in get_first_parent_churn(
+                repo, functools.lru_cache(maxsize=None)(path_filter)
+            ):
+                if state is not None and (
+                    hexsha == state["last_commit"].hexsha
+                    or committed_date <= state["last_commit"].committed_date
+                ):
+                    break  # Everything from here on was analyzed by the previous run
+                chain.append((hexsha, committed_date, churn))
+                bar.update()
+            # Spread the samples out so that about as many lines change between any two of them,
+            # i.e. sample the commits where the lines changed since HEAD pass a multiple of `step`
+            step = sum(churn for _, _, churn in chain) / max(adaptive_samples - 1, 1)
+            changed = 0  # Lines changed since HEAD
+            next_changed = 0
+            for hexsha, committed_date, churn in chain:
+                if changed >= next_changed:
+                    master_commits.append(MiniCommit(hexsha, committed_date))
+                    while next_changed <= changed:
+                        next_changed += step or float("inf")
+                changed += churn
+            del chain
+        else:
+            last_date = None
+            for hexsha, committed_date in iter_log(
+                repo, 2, "HEAD", "--", first_parent=True, format="%H%x00%ct"
+            ):
+                committed_date = int(committed_date)
+                if state is not None and (
+                    hexsha == state["last_commit"].hexsha
+                    or committed_date <= state["last_commit"].committed_date + interval
+                ):
+                    break  # Everything from here on was analyzed by the previous run
+                if last_date is None or committed_date < last_date - interval:
+                    master_commits.append(MiniCommit(hexsha, committed_date))
+                    last_date = committed_date
+                bar.update()
+    end_phase("backtrack")
+
+    if state is not None and not master_commits:
+        if not quiet:
+            print("No new commits to analyze since the last run")
+        return finish(
+            {"commits": 0, "entries": 0, "blamed_entries": 0, "moved_entries": 0}
+        )
+
+    own_pool = pool is None  # Unless it's shared with other repos
+    blame_cache, commit_table, spill_dir, blamer = None, None, None, None
+
+    def cleanup(terminate=False):
+        # Removes the temporary files of the analysis, also if it failed or was interrupted
+        if blamer is not None:
+            blamer.close()
+        if commit_table is not None:
+            commit_table.close()
+        if own_pool and pool is not None:
+            pool.close(terminate)
+        if blame_cache is not None:
+            blame_cache.close()
+        if spill_dir is not None:
+            shutil.rmtree(spill_dir, ignore_errors=True)
+
+    try:
+        if cache:
+            blame_cache = BlameCache(
+                os.path.join(repo.git_dir, "theseus_blame_cache.sqlite3"),
+                blame_kwargs,
+                cache_size * 1024 * 1024,
+                incremental_blame,
+            )
+        else:
+            blame_cache = None
+
+        ok_entry_paths = (
+            blame_cache.get_path_filter(path_filter.key)
+            if blame_cache is not None
+            else {}
+        )
+        new_entry_paths = {}  # Paths that weren't in the blame cache yet
+
+        def entry_path_ok(path):
+            # All this matching is slow so let's cache it
+            if path not in ok_entry_paths:
+                ok_entry_paths[path] = new_entry_paths[path] = path_filter(path)
+            return ok_entry_paths[path]
+
+        master_commits = master_commits[
+            ::-1
+        ]  # Reverse it so it's chnological ascending
+        if shard is not None:
+            # Every shard gets an equal slice of the sampled commits, and starts from scratch at its
+            # first one. The shards only have to agree on the last one to be merged
+            last_hexsha = master_commits[-1].hexsha if master_commits else None
+            n = len(master_commits)
+            master_commits = master_commits[
+                (shard[0] - 1) * n // shard[1] : shard[0] * n // shard[1]
+            ]
+            if not master_commits:
+                raise ValueError(
+                    "Shard {:d} of {:d} has no commits, {:d} commits can be split into at most {:d} shards".format(
+                        *shard, n, n
+                    )
                 )
-            ) and (
-                path_match_zero
-                or fnmatch.fnmatch(
-                    path,
-                    path_match_str,
-                    flags=fnmatch.NEGATE | fnmatch.EXTMATCH | fnmatch.SPLIT,
+        entries_total = 0  # Files at all commits, counted as they're diffed
+        prev_hexsha = state["last_commit"].hexsha if state is not None else None
+
+        curves = {}  # multiple y axis, in the form key_tuple: Array[y-axis points]
+        ts = []  # x axis
+        last_file_y = (
+            {}
+        )  # Contributions of each individual file to each individual curve, when the file was last seen
+        cur_y = None  # Sum of all contributions between files towards each individual curve, indexed by key id
+        seen_keys = None  # Keys that were part of any file, indexed by key id
+        last_file_runs = (
+            {} if incremental_blame else None
+        )  # Blamed commit of each line range of each file, when the file was last seen
+        commit_history = (
+            {}
+        )  # How many lines of a commit (by SHA) still exist at a given time, only kept when it changes
+        last_file_hash = {}  # File SHAs when they were last seen
+        last_commit = None
+
+        if state is not None:
+            if not quiet:
+                print(
+                    "Resuming from {:s}, {:d} new commits to analyze".format(
+                        state_fn, len(master_commits)
+                    )
                 )
+            ts = state["ts"]
+            curves = state["curves"]
+            for key_tuple in curve_key_tuples.difference(state["curve_key_tuples"]):
+                curves[key_tuple] = [0] * len(ts)  # Curves that didn't exist before
+            curve_key_tuples.update(state["curve_key_tuples"])
+            last_file_y = state["last_file_y"]
+            cur_y = state["cur_y"]
+            seen_keys = state["seen_keys"]
+            if incremental_blame:
+                last_file_runs = state["last_file_runs"]
+            commit_history = state["commit_history"]
+            last_file_hash = state["last_file_hash"]
+            last_commit = state["last_commit"]
+
+        for key_tuple in sorted(curve_key_tuples):
+            key_index.add(key_tuple)
+        curve_keys = sorted(curve_key_tuples)
+        curve_ids = key_index.get_ids(curve_keys)
+        sha_mask = key_index.sha_mask()
+        author_ids = numpy.array(
+            [key_index.get_ids(pair) for pair in author_keys], dtype=numpy.int64
+        ).reshape(-1, 2)
+        commit_ids = numpy.array(
+            [key_index.commit_ids[binsha] for binsha in commit_binshas],
+            dtype=numpy.int64,
+        ).reshape(-1, 2)
+        commit_table = CommitTable(
+            commit_binshas, numpy.hstack([commit_ids, author_ids[commit_authors]])
+        )
+        del commit_binshas, commit_authors, author_keys, author_ids, commit_ids
+        if cur_y is None:
+            cur_y = numpy.zeros(len(key_index), dtype=numpy.int64)
+            seen_keys = numpy.zeros(len(key_index), dtype=bool)
+        else:  # Make room for keys added since the last incremental run
+            cur_y = numpy.concatenate(
+                [cur_y, numpy.zeros(len(key_index) - len(cur_y), dtype=numpy.int64)]
+            )
+            seen_keys = numpy.concatenate(
+                [seen_keys, numpy.zeros(len(key_index) - len(seen_keys), dtype=bool)]
+            )
+        last_sha_count = numpy.full(
+            len(key_index), -1, dtype=numpy.int64
+        )  # Last count in commit_history of each sha key, -1 if it has none yet
+        for hexsha, history in commit_history.items():
+            last_sha_count[key_index.commit_ids[bytes.fromhex(hexsha)][0]] = history[
+                -1
+            ][1]
+        if max_memory is not None:
+            # Results go to disk as they come in, and are read back when they're written out
+            spill_dir = tempfile.mkdtemp(prefix=".theseus_spill_", dir=outdir)
+            curves = CurveSpill(os.path.join(spill_dir, "curves.bin"), curve_keys)
+            commit_history = HistorySpill(
+                os.path.join(spill_dir, "history.bin"), key_index
             )
-        return ok_entry_paths[path]
-
-    def get_entries(commit):
-        tmp = [
-            MiniEntry(entry)
-            for entry in commit.tree.traverse()
-            if entry.type == "blob" and entry_path_ok(entry.path)
-        ]
-        all_entries.append(tmp)
-        return tmp
-
-    master_commits = master_commits[::-1]  # Reverse it so it's chnological ascending
-    entries_total = 0
-    desc = "{:<55s}".format("Discovering entries & caching filenames")
-    with tqdm(
-        desc="{:<55s}".format("Entries Discovered"),
-        unit=" Entries",
-        position=1,
-        **tqdm_args,
-    ) as bar:
-        for i, commit in enumerate(
-            tqdm(master_commits, desc=desc, unit=" Commits", position=0, **tqdm_args)
-        ):
-            for entry in get_entries(commit):
-                entries_total += 1
-                _, ext = os.path.splitext(entry.path)
-                curve_key_tuples.add(("ext", ext))
-                curve_key_tuples.add(("dir", get_top_dir(entry.path)))
-                bar.update()
-            master_commits[i] = MiniCommit(
-                commit
-            )  # Might have cached the entries, we don't want that
-
-    # We don't need these anymore, let GC Cleanup
-    del repo
-    del ok_entry_paths
-    del commit
-    # End GC Cleanup
-
-    curves = {}  # multiple y axis, in the form key_tuple: Array[y-axis points]
-    ts = []  # x axis
-    last_file_y = (
-        {}
-    )  # Contributions of each individual file to each individual curve, when the file was last seen
-    cur_y = {}  # Sum of all contributions between files towards each individual curve
-    blamer = BlameDriver(
-        repo_dir,
-        procs,
-        last_file_y,
-        cur_y,
-        blame_kwargs,
-        commit2cohort,
-        use_mailmap,
-        quiet,
-    )
-    commit_history = (
-        {}
-    )  # How many lines of a commit (by SHA) still exist at a given time
-    last_file_hash = {}  # File SHAs when they were last seen
 
-    # Allow script to be paused and process count to change
-    def handler(a, b):
-        try:
-            blamer.pause()
-            print("\n\nProcess paused")
-            x = int(
-                input(
-                    "0. Exit\n1. Continue\n2. Modify process count\nSelect an option: "
-                )
+        def add_curve_keys(key_tuples):
+            # Extensions & dirs get a curve once their first file shows up, with zeros up to then
+            nonlocal curve_ids, sha_mask, cur_y, seen_keys, last_sha_count
+            if not key_tuples:
+                return
+            for key_tuple in key_tuples:
+                curve_key_tuples.add(key_tuple)
+                key_index.add(key_tuple)
+                curve_keys.append(key_tuple)
+                if max_memory is None:
+                    curves[key_tuple] = [0] * len(ts)
+                else:
+                    curves.add_column(key_tuple)
+            curve_ids = key_index.get_ids(curve_keys)
+            n = len(key_index) - len(cur_y)
+            sha_mask = numpy.concatenate([sha_mask, numpy.zeros(n, dtype=bool)])
+            cur_y = numpy.concatenate([cur_y, numpy.zeros(n, dtype=numpy.int64)])
+            seen_keys = numpy.concatenate([seen_keys, numpy.zeros(n, dtype=bool)])
+            last_sha_count = numpy.concatenate(
+                [last_sha_count, numpy.full(n, -1, dtype=numpy.int64)]
             )
+            blamer.cur_y, blamer.seen_keys = cur_y, seen_keys
+
+        if own_pool:
+            pool = BlamePool(procs, quiet, profile)
+        blamer = BlameDriver(
+            pool,
+            repo_dir,
+            key_index.key_ids,
+            last_file_y,
+            cur_y,
+            seen_keys,
+            RepoBlamer(
+                repo_dir,
+                blame_kwargs,
+                key_index.key_ids,
+                commit_table,
+                mailmap,
+                last_file_runs is not None or blame_cache is not None,
+                find_renames,
+            ),
+            last_file_runs,
+            blame_cache,
+        )
 
-            if x == 1:
-                return blamer.resume()
-            elif x == 2:
+        # Allow script to be paused and process count to change
+        def handler(a, b):
+            try:
+                pool.pause()
+                print("\n\nProcess paused")
                 x = int(
                     input(
-                        "\n\nCurrent Processes: {:d}\nNew Setting: ".format(
-                            blamer.proc_count
-                        )
+                        "0. Exit\n1. Continue\n2. Modify process count\nSelect an option: "
                     )
                 )
-                if x > 0:
-                    blamer.proc_count = x
-                    blamer.spawn_process(spawn_only=True)
-                return blamer.resume()
-            os._exit(1)  # sys.exit() does weird things
-        except:
-            pass
-        handler(None, None)
 
-    if not quiet:
-        signal.signal(signal.SIGINT, handler)
-
-    desc = "{:<55s}".format(
-        "Analyzing commit history with {:d} processes".format(procs)
-    )
-    with tqdm(
-        desc="{:<55s}".format("Entries Processed"),
-        total=entries_total,
-        unit=" Entries",
-        position=1,
-        maxinterval=1,
-        miniters=100,
-        **tqdm_args,
-    ) as bar:
-        cbar = tqdm(master_commits, desc=desc, unit=" Commits", position=0, **tqdm_args)
-        for commit in cbar:
-            t = datetime.datetime.utcfromtimestamp(commit.committed_date)
-            ts.append(t)  # x axis
-
-            # START: Fast diff, to reduce no. of files checked via blame.
-            # File hashes are checked against previous iteration
-            entries = all_entries.pop(
-                0
-            )  # all_entries grows smaller as curves grows larger
-
-            check_entries = []
-            cur_file_hash = {}
-            for entry in entries:
-                cur_file_hash[entry.path] = entry.binsha
-                if entry.path in last_file_hash:
-                    if last_file_hash[entry.path] != entry.binsha:  # Modified file
-                        for key_tuple, count in last_file_y[entry.path].items():
-                            cur_y[key_tuple] -= count
-                        check_entries.append(entry)
-                    else:  # Identical file
-                        bar.update()
-                    del last_file_hash[
-                        entry.path
-                    ]  # Identical/Modified file removed, leaving deleted files behind
-                else:  # Newly added file
-                    check_entries.append(entry)
-            for deleted_path in last_file_hash.keys():  # Deleted files
-                for key_tuple, count in last_file_y[deleted_path].items():
-                    cur_y[key_tuple] -= count
-            last_file_hash = cur_file_hash
-            # END: Fast diff
-
-            # Multiprocess blame checker, updates cur_y & last_file_y
-            blamer.fetch(commit, check_entries, bar)
-            cbar.set_description(
-                "{:<55s}".format(
-                    "Analyzing commit history with {:d} processes".format(
-                        len(blamer.proc_pool)
+                if x == 1:
+                    return pool.resume()
+                elif x == 2:
+                    x = int(
+                        input(
+                            "\n\nCurrent Processes: {:d}\nNew Setting: ".format(
+                                pool.proc_count
+                            )
+                        )
                     )
+                    if x > 0:
+                        pool.proc_count = x
+                        pool.spawn_process(spawn_only=True)
+                    return pool.resume()
+                cleanup(terminate=True)
+                os._exit(1)  # sys.exit() does weird things
+            except:
+                pass
+            handler(None, None)
+
+        if (
+            not quiet and own_pool
+        ):  # Shared pools are run from other threads, which can't handle signals
+            signal.signal(signal.SIGINT, handler)
+
+        desc = "{:<55s}".format(
+            "Analyzing commit history with {:d} processes".format(procs)
+        )
+        with tqdm(
+            desc="{:<55s}".format("Entries Processed"),
+            unit=" Entries",
+            position=1,
+            maxinterval=1,
+            miniters=100,
+            **tqdm_args,
+        ) as bar:
+            submitted = (
+                []
+            )  # Files to subtract from cur_y, and deleted files, of each submitted commit
+            discovered = 0  # Commits whose tree diffs were sent to the workers
+            # The diffs are split into contiguous ranges of commits, so all workers get some
+            range_size = max(
+                1,
+                min(
+                    DISCOVER_RANGE_COMMITS,
+                    -(-len(master_commits) // max(pool.proc_count, 1)),
                 ),
-                False,
             )
 
-            for key_tuple, count in cur_y.items():
-                key_category, key = key_tuple
-                if key_category == "sha":
-                    commit_history.setdefault(key, []).append(
-                        (commit.committed_date, count)
+            def get_pipeline_depth():
+                # By default there's a commit in flight per process, as commits that changed only a
+                # few files don't have a chunk for every process
+                if pipeline_depth is None:
+                    return max(MIN_PIPELINE_DEPTH, pool.proc_count)
+                return max(pipeline_depth, 1)
+
+            def submit(idx):
+                nonlocal discovered, entries_total
+                # Workers diff the trees of the commits a few ranges ahead of the ones being blamed,
+                # in between their blames
+                while discovered < min(
+                    idx + get_pipeline_depth() + range_size * pool.proc_count,
+                    len(master_commits),
+                ):
+                    end = min(discovered + range_size, len(master_commits))
+                    blamer.discover(
+                        discovered,
+                        [
+                            (
+                                master_commits[j - 1].hexsha if j > 0 else prev_hexsha,
+                                master_commits[j].hexsha,
+                            )
+                            for j in range(discovered, end)
+                        ],
                     )
+                    discovered = end
+
+                # START: Fast diff, to reduce no. of files checked via blame.
+                # Only files that changed since the previous sampled commit are listed
+                check_entries = []
+                stale_paths = []
+                deleted_paths = []
+                deleted_binshas = {}  # binsha: deleted paths of that blob
+                added_entries = []
+                new_keys = set()
+                for path, binsha, old_path in blamer.get_changes(idx, bar):
+                    if not entry_path_ok(path):
+                        continue
+                    if binsha is None:  # Deleted file
+                        old_binsha = last_file_hash.pop(path, None)
+                        if old_binsha is not None:
+                            deleted_paths.append(path)
+                            deleted_binshas.setdefault(old_binsha, []).append(path)
+                        continue
+                    new_keys.update(get_path_keys(path))
+                    if path in last_file_hash:
+                        if last_file_hash[path] == binsha:
+                            continue  # Identical file
+                        stale_paths.append(path)  # Modified file
+                        check_entries.append(MiniEntry(path, binsha))
+                    else:
+                        added_entries.append(MiniEntry(path, binsha, old_path))
+                    last_file_hash[path] = binsha
+                # With find_renames, a new file with the blob of a deleted one is taken to be moved
+                # there, and keeps its blame
+                moved_paths = []
+                for entry in added_entries:
+                    if find_renames and deleted_binshas.get(entry.binsha):
+                        moved_paths.append(
+                            (deleted_binshas[entry.binsha].pop(), entry.path)
+                        )
+                    else:
+                        check_entries.append(entry)  # Newly added file
+                add_curve_keys(sorted(new_keys.difference(curve_key_tuples)))
+                entries_total += len(last_file_hash)
+                bar.update(
+                    len(last_file_hash) - len(check_entries)
+                )  # Identical & moved files
+                # END: Fast diff
+
+                blamer.submit(idx, master_commits[idx], check_entries)
+                submitted.append(
+                    (stale_paths + deleted_paths, deleted_paths, moved_paths)
+                )
 
-            for key_tuple in curve_key_tuples:
-                curves.setdefault(key_tuple, []).append(cur_y.get(key_tuple, 0))
-
-    signal.signal(signal.SIGINT, signal.default_int_handler)
+            cbar = tqdm(
+                master_commits, desc=desc, unit=" Commits", position=0, **tqdm_args
+            )
+            for i, commit in enumerate(cbar):
+                # Keep a few commits in flight, so workers don't sit idle at the tail of each commit.
+                # Over the memory limit, only one is, as the results of each take up memory
+                depth = get_pipeline_depth()
+                if max_memory is not None and get_rss_mb() > max_memory:
+                    gc.collect()
+                    depth = 1
+                while len(submitted) < min(i + depth, len(master_commits)):
+                    submit(len(submitted))
+
+                stale_paths, deleted_paths, moved_paths = submitted[i]
+                submitted[i] = None  # Let GC clean up
+                for path in stale_paths:
+                    key_ids, counts = last_file_y[path]
+                    cur_y[key_ids] -= counts
+                for old_path, path in moved_paths:
+                    blamer.move(commit.hexsha, old_path, path)
+                if last_file_runs is not None:
+                    for path in deleted_paths:
+                        last_file_runs.pop(path, None)
+
+                # Multiprocess blame checker, updates cur_y & last_file_y
+                blamer.fetch(i, bar)
+                cbar.set_description(
+                    "{:<55s}".format(
+                        "Analyzing commit history with {:d} processes".format(
+                            len(pool.proc_pool)
+                        )
+                    ),
+                    False,
+                )
 
-    def dump_json(output_fn, key_type, label_fmt=lambda x: x):
-        key_items = sorted(k for t, k in curve_key_tuples if t == key_type)
-        fn = os.path.join(outdir, output_fn)
-        if not quiet:
-            print("Writing %s data to %s" % (key_type, fn))
-        f = open(fn, "w")
-        json.dump(
-            {
-                "y": [curves[(key_type, key_item)] for key_item in key_items],
-                "ts": [t.isoformat() for t in ts],
-                "labels": [label_fmt(key_item) for key_item in key_items],
+                sha_ids = numpy.flatnonzero(
+                    seen_keys & sha_mask & (cur_y != last_sha_count)
+                )
+                if max_memory is None:
+                    for sha_id, count in zip(sha_ids, cur_y[sha_ids].tolist()):
+                        commit_history.setdefault(
+                            key_index.keys[sha_id][1].hex(), []
+                        ).append((commit.committed_date, count))
+                    for key_tuple, count in zip(curve_keys, cur_y[curve_ids].tolist()):
+                        curves.setdefault(key_tuple, []).append(count)
+                else:
+                    commit_history.append(
+                        sha_ids, commit.committed_date, cur_y[sha_ids]
+                    )
+                    curves.append(cur_y[curve_ids])
+                ts.append(
+                    datetime.datetime.utcfromtimestamp(commit.committed_date)
+                )  # x axis
+                last_sha_count[sha_ids] = cur_y[sha_ids]
+                last_commit = commit
+
+        if not quiet and own_pool:
+            signal.signal(signal.SIGINT, signal.default_int_handler)
+        blamer.close()
+        commit_table.close()
+        end_phase("blame")
+
+        if blame_cache is not None:
+            blame_cache.put_path_filter(path_filter.key, new_entry_paths)
+            if not quiet:
+                print(
+                    "Blame cache: {:d} hits, {:d} misses".format(
+                        blame_cache.hits, blame_cache.misses
+                    )
+                )
+            blame_cache.close()
+
+        # The pool stats are of all repos, if the pool is shared
+        spawn_count, spawn_time = pool.spawn_stats
+        idle_time, busy_time = pool.worker_stats
+        stats = {
+            "commits": len(master_commits),
+            "entries": entries_total,
+            "blamed_entries": blamer.blamed_entries,
+            "moved_entries": blamer.moved_entries,
+            "git_processes": spawn_count.value,
+            "git_process_seconds": spawn_time.value,
+            "git_bytes_read": blamer.git_bytes_read,
+            "blob_bytes": blamer.blob_bytes,
+            "chunks_sent": blamer.chunks_sent,
+            "results_received": blamer.results_received,
+            "cache_hits": blame_cache.hits if blame_cache is not None else 0,
+            "cache_misses": blame_cache.misses if blame_cache is not None else 0,
+            "worker_idle_seconds": idle_time.value,
+            "worker_busy_seconds": busy_time.value,
+            "file_blame_seconds": {
+                "buckets": BLAME_SECONDS_BUCKETS,
+                "counts": blamer.blame_seconds.tolist(),
+                "sum": blamer.blame_seconds_sum,
             },
-            f,
-        )
-        f.close()
+            "worker_peak_rss_mb": None,
+        }
+        if own_pool:
+            if not quiet:
+                print(
+                    "Started {:d} git processes, {:.1f}s spent starting them".format(
+                        spawn_count.value, spawn_time.value
+                    )
+                )
+            pool.close()
+            stats["worker_peak_rss_mb"] = get_peak_rss_mb(children=True)
+
+        if shard is not None:
+            fn = os.path.join(outdir, "shard_{:d}_of_{:d}.pickle".format(*shard))
+            if not quiet:
+                print("Writing shard to %s" % fn)
+            with open(fn, "wb") as f:
+                pickle.dump(
+                    {
+                        "settings": settings,
+                        "interval": interval,
+                        "shard": shard,
+                        "last_hexsha": last_hexsha,
+                        "ts": ts,
+                        "curves": curves,
+                        "curve_key_tuples": curve_key_tuples,
+                        "commit_history": commit_history,
+                    },
+                    f,
+                )
+        elif max_memory is not None:
+            curves.finish()
+            commit_history.finish()
+            dump_results(
+                outdir, ts, curves, curve_key_tuples, commit_history, npz, quiet
+            )
+            curves.close()
+            commit_history.close()
+            os.rmdir(spill_dir)
+        else:
+            dump_results(
+                outdir, ts, curves, curve_key_tuples, commit_history, npz, quiet
+            )
 
-    # Dump accumulated stuff
-    dump_json("cohorts.json", "cohort", lambda c: "Code added in %s" % c)
-    dump_json("exts.json", "ext")
-    dump_json("authors.json", "author")
-    dump_json("dirs.json", "dir")
-    dump_json("domains.json", "domain")
+        if incremental and last_commit is not None:
+            if not quiet:
+                print("Writing state for incremental runs to %s" % state_fn)
+            with open(state_fn, "wb") as f:
+                pickle.dump(
+                    {
+                        "settings": settings,
+                        "last_commit": last_commit,
+                        "ts": ts,
+                        "curves": curves,
+                        "curve_key_tuples": curve_key_tuples,
+                        "last_file_y": last_file_y,
+                        "key_index": key_index,
+                        "cur_y": cur_y,
+                        "seen_keys": seen_keys,
+                        "last_file_runs": last_file_runs,
+                        "commit_history": commit_history,
+                        "last_file_hash": last_file_hash,
+                    },
+                    f,
+                )
+    finally:
+        cleanup()
 
-    # Dump survival data
-    fn = os.path.join(outdir, "survival.json")
-    f = open(fn, "w")
-    if not quiet:
-        print("Writing survival data to %s" % fn)
-    json.dump(commit_history, f)
-    f.close()
+    end_phase("write")
+
+    return finish(stats)
 
 
 @functools.lru_cache(maxsize=None)
@@ -552,8 +1876,37 @@ def get_mailmap_author_name_email(repo, author_name, author_email):
     return mailmap_name, mailmap_email
 
 
-def analyze_cmdline():
-    parser = argparse.ArgumentParser(description="Analyze git repo")
+def get_mailmap_authors(repo, authors):
+    # Maps every (name, email) to its mailmapped (name, email), with a single `git check-mailmap`
+    # that reads them all from stdin. Old Gits don't have --stdin, those map them one by one
+    proc = repo.git.check_mailmap(stdin=True, as_process=True, istream=subprocess.PIPE)
+    out, _ = proc.communicate(
+        "".join(
+            f"{author_name} <{author_email}>\n" for author_name, author_email in authors
+        ).encode()
+    )
+    lines = out.decode("utf-8", "replace").splitlines()
+    if proc.returncode != 0 or len(lines) != len(authors):
+        return {
+            author: get_mailmap_author_name_email(repo, *author) for author in authors
+        }
+    return {
+        author: tuple(line[:-1].split(" <", maxsplit=1))
+        for author, line in zip(authors, lines)
+    }
+
+
+def parse_shard(value):
+    try:
+        k, n = map(int, value.split("/"))
+    except ValueError:
+        raise argparse.ArgumentTypeError("Expected K/N, got %r" % value)
+    if not 1 <= k <= n:
+        raise argparse.ArgumentTypeError("Shard %d doesn't exist out of %d" % (k, n))
+    return k, n
+
+
+def add_analyze_arguments(parser):
     parser.add_argument(
         "--cohortfm",
         default="%Y",
@@ -598,8 +1951,7 @@ def analyze_cmdline():
     parser.add_argument(
         "--all-filetypes",
         action="store_true",
-        help="Include all files (if not set then will only analyze %s"
-        % ",".join(default_filetypes),
+        help="Include all files (if not set then will only analyze files that Pygments recognizes as source code, not counting configuration and documentation files)",
     )
     parser.add_argument(
         "--quiet",
@@ -612,11 +1964,76 @@ def analyze_cmdline():
         type=int,
         help="Number of processes to use. There is a point of diminishing returns, and RAM may become an issue on large repos (default: %(default)s)",
     )
+    parser.add_argument(
+        "--pipeline-depth",
+        type=int,
+        help="Number of sampled commits to blame concurrently, so processes don't wait for the slowest file of each commit. Higher values keep more processes busy, at the cost of more RAM (default: the number of processes, and at least %d)"
+        % MIN_PIPELINE_DEPTH,
+    )
     parser.add_argument(
         "--opt",
         action="store_true",
         help="Generates git commit-graph; Improves performance at the cost of some (~80KB/kCommit) disk space (default: %(default)s)",
     )
+    parser.add_argument(
+        "--incremental-blame",
+        action="store_true",
+        help="Only blame the lines of modified files that changed since the last analyzed commit, and carry forward the blame of all other lines. Much faster on large files, but lines that were removed and re-added between two analyzed commits keep their old attribution (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--find-renames",
+        action="store_true",
+        help="Take files with the same contents as a deleted one to be moved, and keep their blame rather than blaming them again. This is an approximation, see the README. With --incremental-blame, files that were renamed and changed between two analyzed commits also only get the lines that changed blamed (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--cache",
+        action="store_true",
+        help="Cache blame results in .git/theseus_blame_cache.sqlite3, so repeated or interrupted runs skip files that were already blamed (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--cache-size",
+        default=512,
+        type=int,
+        help="Max size of the blame cache in MB, least recently used entries are evicted beyond that (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Save the analysis state to state.pickle in the output directory, and if a previous state exists, only analyze the commits made since then (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--npz",
+        action="store_true",
+        help="Also write the results as uncompressed NumPy .npz files next to the .json ones, which are much faster for the plotting tools to load on big repos (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--adaptive-samples",
+        type=int,
+        help="Instead of one commit per --interval, analyze about this many commits, spread out so that about as many lines change between any two of them. Puts the blame work where the code changed the most. Lines changed are counted with one `git log --numstat`, which is cheap next to blaming",
+    )
+    parser.add_argument(
+        "--max-memory",
+        type=int,
+        help="Try to keep the RAM used by the main process under this many MB. The results are written to disk as they come in rather than kept in RAM, and fewer commits are blamed at once whenever the limit is exceeded. A bit slower. Can't be combined with --incremental or --shard",
+    )
+    parser.add_argument(
+        "--metrics",
+        help="Write metrics of the run (time of each phase, blame times, cache hits, worker idle time, peak memory etc.) to this file. As a Prometheus textfile if it ends with .prom, JSON otherwise",
+    )
+    parser.add_argument(
+        "--profile",
+        help="Profile the run with cProfile, and write the stats of the main process and of each worker to this directory",
+    )
+    parser.add_argument(
+        "--shard",
+        type=parse_shard,
+        help="Only analyze shard K of N (as K/N, counting from 1) of the sampled commits, and write it to shard_K_of_N.pickle in the output directory. Shards can run on different machines, and git-of-theseus-merge-shards combines them into the usual results once they're all done",
+    )
+
+
+def analyze_cmdline():
+    parser = argparse.ArgumentParser(description="Analyze git repo")
+    add_analyze_arguments(parser)
     parser.add_argument("repo_dir")
     kwargs = vars(parser.parse_args())
 
@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2016 Erik Bernhardsson
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import argparse
+import concurrent.futures
+import json
+import os
+import shlex
+import time
+
+from git_of_theseus.analyze import BlamePool, add_analyze_arguments, analyze
+
+
+def read_manifest(manifest, outdir, branch):
+    # One repo per line: `repo_dir [branch [outdir]]`, blank lines and lines starting with # are skipped
+    jobs = []
+    with open(manifest) as f:
+        for line in f:
+            fields = shlex.split(line, comments=True)
+            if not fields:
+                continue
+            if len(fields) > 3:
+                raise ValueError("Invalid manifest line: %r" % line)
+            repo_dir = fields[0]
+            repo_outdir = (
+                fields[2]
+                if len(fields) > 2
+                else os.path.join(outdir, os.path.basename(os.path.abspath(repo_dir)))
+            )
+            jobs.append(
+                (repo_dir, fields[1] if len(fields) > 1 else branch, repo_outdir)
+            )
+    outdirs = [repo_outdir for _, _, repo_outdir in jobs]
+    if len(set(outdirs)) != len(outdirs):
+        raise ValueError(
+            "Several repos in %s write to the same output directory, give them an outdir of their own"
+            % manifest
+        )
+    return jobs
+
+
+def batch_analyze(
+    manifest,
+    outdir=".",
+    branch="master",
+    procs=2,
+    jobs=4,
+    quiet=False,
+    metrics=None,
+    profile=None,
+    **kwargs,
+):
+    repo_jobs = read_manifest(manifest, outdir, branch)
+    # A few repos are analyzed at once, and all of their blames go to one pool, so the workers
+    # stay busy while a repo is reading its history or writing its results
+    if profile is not None and not os.path.exists(profile):
+        os.makedirs(profile)
+    pool = BlamePool(procs, quiet, profile)
+    stats = {}
+    start = time.perf_counter()
+
+    def run(repo_dir, repo_branch, repo_outdir):
+        repo_start = time.perf_counter()
+        repo_stats = analyze(
+            repo_dir,
+            outdir=repo_outdir,
+            branch=repo_branch,
+            quiet=True,
+            pool=pool,
+            # Each repo gets its own metrics file & main process profile. Only one profiler can run
+            # at once though, so repos that are analyzed side by side only get the workers profiled
+            metrics=(
+                os.path.join(repo_outdir, os.path.basename(metrics))
+                if metrics is not None
+                else None
+            ),
+            profile=(
+                os.path.join(profile, os.path.basename(os.path.abspath(repo_outdir)))
+                if profile is not None and jobs <= 1
+                else None
+            ),
+            **kwargs,
+        )
+        repo_stats["seconds"] = time.perf_counter() - repo_start
+        return repo_stats
+
+    failed = 0
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(jobs, 1)) as executor:
+        futures = {executor.submit(run, *repo_job): repo_job for repo_job in repo_jobs}
+        for future in concurrent.futures.as_completed(futures):
+            repo_dir, _, repo_outdir = futures[future]
+            try:
+                repo_stats = future.result()
+            except Exception as e:
+                failed += 1
+                stats[repo_outdir] = {"repo_dir": repo_dir, "error": repr(e)}
+                if not quiet:
+                    print("%s: failed: %r" % (repo_dir, e))
+                continue
+            repo_stats["repo_dir"] = repo_dir
+            stats[repo_outdir] = repo_stats
+            if not quiet:
+                print(
+                    "%s: %d commits, %d files blamed in %.1fs"
+                    % (
+                        repo_dir,
+                        repo_stats["commits"],
+                        repo_stats["blamed_entries"],
+                        repo_stats["seconds"],
+                    )
+                )
+
+    seconds = time.perf_counter() - start
+    spawn_count, spawn_time = pool.spawn_stats
+    pool.close()
+    totals = {
+        "repos": len(repo_jobs),
+        "failed": failed,
+        "seconds": seconds,
+        "commits": sum(s.get("commits", 0) for s in stats.values()),
+        "entries": sum(s.get("entries", 0) for s in stats.values()),
+        "blamed_entries": sum(s.get("blamed_entries", 0) for s in stats.values()),
+        "git_processes": spawn_count.value,
+        "git_process_seconds": spawn_time.value,
+    }
+    if not quiet:
+        print(
+            "Analyzed %d repos (%d failed) in %.1fs: %.1f commits/s, %.1f files blamed/s"
+            % (
+                totals["repos"],
+                failed,
+                seconds,
+                totals["commits"] / max(seconds, 1e-9),
+                totals["blamed_entries"] / max(seconds, 1e-9),
+            )
+        )
+        print(
+            "Started {:d} git processes, {:.1f}s spent starting them".format(
+                spawn_count.value, spawn_time.value
+            )
+        )
+    if not os.path.exists(outdir):
+        os.makedirs(outdir)
+    fn = os.path.join(outdir, "batch_stats.json")
+    if not quiet:
+        print("Writing batch stats to %s" % fn)
+    with open(fn, "w") as f:
+        json.dump({"totals": totals, "repos": stats}, f)
+    return totals
+
+
+def batch_analyze_cmdline():
+    parser = argparse.ArgumentParser(
+        description="Analyze many git repos, sharing one pool of blame processes between them"
+    )
+    add_analyze_arguments(parser)
+    parser.add_argument(
+        "--jobs",
+        default=4,
+        type=int,
+        help="Number of repos to analyze at once. Their blames all run on the same --procs processes (default: %(default)s)",
+    )
+    parser.add_argument(
+        "manifest",
+        help="File with one repo per line, as `repo_dir [branch [outdir]]`. Outputs go to <outdir>/<repo dir name> unless a repo has an outdir of its own",
+    )
+    kwargs = vars(parser.parse_args())
+
+    try:
+        totals = batch_analyze(**kwargs)
+    except KeyboardInterrupt:
+        exit(1)
+    if totals["failed"]:
+        exit(1)
+
+
+if __name__ == "__main__":
+    batch_analyze_cmdline()
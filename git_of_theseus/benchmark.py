@@ -0,0 +1,374 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2016 Erik Bernhardsson
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import tempfile
+import time
+
+import git
+
+from git_of_theseus.analyze import analyze
+
+EXTS = [".py", ".c", ".js", ".go"]
+DIRS = 8  # Number of top level dirs the files are spread over
+
+
+def generate_repo(
+    repo_dir,
+    commits=1000,
+    files=200,
+    churn=0.02,
+    authors=20,
+    file_lines=200,
+    seed=0,
+):
+    """Generates a git repo with a synthetic history, deterministically for a given seed.
+
+    Every commit changes a `churn` fraction of the `files` paths: by adding them if they
+    don't exist, editing some of their lines, or now and then deleting them. Commits are a
+    day apart. The history is written with `git fast-import`, so it's fast even for big repos.
+    """
+    rng = random.Random(seed)
+    os.makedirs(repo_dir)
+    subprocess.run(["git", "init", "-q", repo_dir], check=True)
+    subprocess.run(
+        ["git", "symbolic-ref", "HEAD", "refs/heads/master"], cwd=repo_dir, check=True
+    )
+    paths = [
+        "dir{:d}/file{:d}{:s}".format(i % DIRS, i, EXTS[i % len(EXTS)])
+        for i in range(files)
+    ]
+    contents = {}  # path: lines
+    line_ids = iter(range(1 << 62))
+    t = 1420070400  # 2015-01-01
+
+    def new_line():
+        return "value_{:d} = {:x}\n".format(next(line_ids), rng.getrandbits(32))
+
+    proc = subprocess.Popen(
+        ["git", "fast-import", "--quiet"], cwd=repo_dir, stdin=subprocess.PIPE
+    )
+
+    def write_data(data):
+        data = data.encode()
+        proc.stdin.write(b"data %d\n%s\n" % (len(data), data))
+
+    for i in range(commits):
+        author = rng.randrange(authors)
+        ident = "Author {:d} <author{:d}@example{:d}.com> {:d} +0000\n".format(
+            author, author, author % 3, t
+        )
+        proc.stdin.write(b"commit refs/heads/master\n")
+        proc.stdin.write(b"author " + ident.encode())
+        proc.stdin.write(b"committer " + ident.encode())
+        write_data("Commit {:d}".format(i))
+        for path in rng.sample(paths, max(1, round(churn * files))):
+            lines = contents.get(path)
+            if lines is not None and rng.random() < 0.02:
+                del contents[path]
+                proc.stdin.write(b"D %s\n" % path.encode())
+                continue
+            if lines is None:
+                lines = [
+                    new_line()
+                    for _ in range(rng.randint(file_lines // 2, file_lines * 3 // 2))
+                ]
+            else:
+                for _ in range(max(1, len(lines) // 10)):
+                    k = rng.randrange(len(lines) + 1)
+                    op = rng.random()
+                    if op < 0.4 or not lines:
+                        lines.insert(k, new_line())
+                    elif op < 0.7:
+                        del lines[min(k, len(lines) - 1)]
+                    else:
+                        lines[min(k, len(lines) - 1)] = new_line()
+            contents[path] = lines
+            proc.stdin.write(b"M 100644 inline %s\n" % path.encode())
+            write_data("".join(lines))
+        t += 24 * 60 * 60
+    proc.stdin.close()
+    if proc.wait():
+        raise RuntimeError("git fast-import failed")
+
+
+def run_trial(repo_dir, procs, conn, kwargs):
+    outdir = tempfile.mkdtemp(prefix="theseus_benchmark_")
+    try:
+        start = time.perf_counter()
+        stats = analyze(repo_dir, outdir=outdir, procs=procs, quiet=True, **kwargs)
+        stats["seconds"] = time.perf_counter() - start
+    finally:
+        shutil.rmtree(outdir, ignore_errors=True)
+    conn.send(stats)
+    conn.close()
+
+
+def benchmark(repo_dir, procs_list=(1, 2, 4), repeat=3, **kwargs):
+    """Runs analyze() on a repo `repeat` times for each no. of procs, and returns the results
+    of the median run of each. Every run gets a fresh process, so peak RSS is its own.
+    """
+    results = []
+    for procs in procs_list:
+        trials = []
+        for _ in range(repeat):
+            recv_conn, send_conn = multiprocessing.Pipe(duplex=False)
+            proc = multiprocessing.Process(
+                target=run_trial, args=(repo_dir, procs, send_conn, kwargs)
+            )
+            proc.start()
+            send_conn.close()
+            try:
+                trials.append(recv_conn.recv())
+            except EOFError:
+                raise RuntimeError("Benchmark run with {:d} procs died".format(procs))
+            proc.join()
+        trials.sort(key=lambda stats: stats["seconds"])
+        stats = trials[len(trials) // 2]
+        seconds = stats["seconds"]
+        results.append(
+            {
+                "procs": procs,
+                "seconds": seconds,
+                "seconds_all": [trial["seconds"] for trial in trials],
+                "commits_per_s": stats["commits"] / seconds,
+                "entries_per_s": stats["entries"] / seconds,
+                "blamed_entries_per_s": stats["blamed_entries"] / seconds,
+                "commits": stats["commits"],
+                "entries": stats["entries"],
+                "blamed_entries": stats["blamed_entries"],
+                "git_processes": stats["git_processes"],
+                "peak_rss_mb": max(trial["peak_rss_mb"] for trial in trials),
+                "worker_peak_rss_mb": max(
+                    trial["worker_peak_rss_mb"] for trial in trials
+                ),
+                "phase_seconds": {
+                    phase: statistics.median(
+                        trial["phase_seconds"][phase] for trial in trials
+                    )
+                    for phase in stats["phase_seconds"]
+                },
+            }
+        )
+    return results
+
+
+# Metrics that are compared between reports, and whether higher is better for them
+COMPARED_METRICS = {
+    "seconds": False,
+    "commits_per_s": True,
+    "entries_per_s": True,
+    "git_processes": False,
+    "peak_rss_mb": False,
+    "worker_peak_rss_mb": False,
+}
+MIN_COMPARED_SECONDS = 0.1  # Shorter timings are mostly noise
+
+
+def compare_reports(base, new, threshold=0.1):
+    """Returns (procs, metric, base value, new value, change) of each metric that got worse by
+    more than `threshold` (as a fraction) between two benchmark reports."""
+    regressions = []
+    base_results = {result["procs"]: result for result in base["results"]}
+    for result in new["results"]:
+        base_result = base_results.get(result["procs"])
+        if base_result is None:
+            continue
+        metrics = [(metric, base_result, result) for metric in COMPARED_METRICS]
+        metrics += [
+            (
+                "phase_seconds." + phase,
+                base_result["phase_seconds"],
+                result["phase_seconds"],
+            )
+            for phase in result["phase_seconds"]
+            if phase in base_result["phase_seconds"]
+        ]
+        for metric, base_values, values in metrics:
+            key = metric.split(".")[-1]
+            higher_is_better = COMPARED_METRICS.get(metric, False)
+            if not base_values[key]:
+                continue
+            if (metric == "seconds" or metric.startswith("phase_seconds.")) and max(
+                base_values[key], values[key]
+            ) < MIN_COMPARED_SECONDS:
+                continue
+            change = values[key] / base_values[key] - 1
+            if (-change if higher_is_better else change) > threshold:
+                regressions.append(
+                    (result["procs"], metric, base_values[key], values[key], change)
+                )
+    return regressions
+
+
+def benchmark_cmdline():
+    parser = argparse.ArgumentParser(
+        description="Benchmark git-of-theseus-analyze on a synthetic repo, or compare two benchmark reports"
+    )
+    parser.add_argument(
+        "--repo-dir",
+        help="Repo to benchmark, it's generated if it doesn't exist yet (default: a temporary one)",
+    )
+    parser.add_argument(
+        "--commits",
+        default=1000,
+        type=int,
+        help="Number of commits of the generated repo (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--files",
+        default=200,
+        type=int,
+        help="Number of file paths of the generated repo (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--churn",
+        default=0.02,
+        type=float,
+        help="Fraction of files changed by each commit of the generated repo (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--authors",
+        default=20,
+        type=int,
+        help="Number of authors of the generated repo (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--file-lines",
+        default=200,
+        type=int,
+        help="Average number of lines of new files in the generated repo (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--seed",
+        default=0,
+        type=int,
+        help="Random seed of the generated repo (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--procs",
+        default=[1, 2, 4],
+        type=int,
+        nargs="+",
+        help="Numbers of processes to benchmark (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--repeat",
+        default=3,
+        type=int,
+        help="Number of runs for each number of processes, the median one is reported (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--incremental-blame",
+        action="store_true",
+        help="Benchmark with --incremental-blame (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--output",
+        default="benchmark.json",
+        help="File to write the report to (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--compare",
+        nargs=2,
+        metavar=("BASE", "NEW"),
+        help="Compare two reports instead of running a benchmark, and exit with status 1 if NEW has regressed",
+    )
+    parser.add_argument(
+        "--threshold",
+        default=0.1,
+        type=float,
+        help="Fraction by which a metric has to get worse to count as a regression (default: %(default)s)",
+    )
+    kwargs = vars(parser.parse_args())
+
+    if kwargs["compare"]:
+        reports = []
+        for fn in kwargs["compare"]:
+            with open(fn) as f:
+                reports.append(json.load(f))
+        regressions = compare_reports(*reports, kwargs["threshold"])
+        for procs, metric, base_value, value, change in regressions:
+            print(
+                "Regression with {:d} procs: {:s} {:.4g} -> {:.4g} ({:+.1%})".format(
+                    procs, metric, base_value, value, change
+                )
+            )
+        if regressions:
+            exit(1)
+        print("No regressions")
+        return
+
+    repo_params = {
+        key: kwargs[key]
+        for key in ["commits", "files", "churn", "authors", "file_lines", "seed"]
+    }
+    tmp_dir = None
+    repo = repo_dir = kwargs["repo_dir"]
+    if repo_dir is None:
+        tmp_dir = tempfile.mkdtemp(prefix="theseus_benchmark_")
+        repo_dir = os.path.join(tmp_dir, "repo")
+    try:
+        if not os.path.exists(repo_dir):
+            print("Generating repo in %s" % repo_dir)
+            generate_repo(repo_dir, **repo_params)
+            repo = repo_params
+        results = benchmark(
+            repo_dir,
+            kwargs["procs"],
+            kwargs["repeat"],
+            incremental_blame=kwargs["incremental_blame"],
+        )
+    finally:
+        if tmp_dir is not None:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    for result in results:
+        print(
+            "{:d} procs: {:.2f}s, {:.1f} commits/s, {:.1f} entries/s, {:d} git processes, {:.0f} MB peak RSS".format(
+                result["procs"],
+                result["seconds"],
+                result["commits_per_s"],
+                result["entries_per_s"],
+                result["git_processes"],
+                result["peak_rss_mb"],
+            )
+        )
+    report = {
+        "repo": repo,  # Generator params, or the path of a repo that already existed
+        "incremental_blame": kwargs["incremental_blame"],
+        "versions": {
+            "python": platform.python_version(),
+            "git": ".".join(map(str, git.Git().version_info)),
+            "gitpython": git.__version__,
+        },
+        "results": results,
+    }
+    print("Writing report to %s" % kwargs["output"])
+    with open(kwargs["output"], "w") as f:
+        json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    benchmark_cmdline()
@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2016 Erik Bernhardsson
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import sqlite3
+import time
+import zlib
+
+# Rough size of a row of filter_paths besides the path, counted towards the size cap
+FILTER_PATH_OVERHEAD = 16
+
+
+def encode_path(path):
+    # Paths that aren't valid UTF-8 come from git as surrogate-escaped strings, which SQLite can't store
+    return path.encode("utf-8", "surrogateescape")
+
+
+class BlameCache:
+    """On-disk cache of blame results, keyed by (commit, path, blame options).
+
+    Values are the blame runs of the file, i.e. a list of [hexsha, n_lines, author name, author email]
+    in file order. These don't depend on the cohort format or on the mailmap, so the cache can be
+    shared between runs with different settings. Incremental blames carry forward an approximate
+    attribution, so they're kept apart from full ones. The least recently used entries are evicted once
+    the cache grows over `max_size` bytes. Whether each path passes the path filters is cached too,
+    and the paths of a set of filters are evicted along with it when it's the least recently used.
+    """
+
+    def __init__(
+        self, fn, blame_kwargs, max_size=512 * 1024 * 1024, incremental_blame=False
+    ):
+        self.fn = fn
+        options = sorted(blame_kwargs.items())
+        if incremental_blame:
+            options.append(("incremental_blame", True))
+        self.options = json.dumps(options)
+        self.max_size = max_size
+        self.conn = sqlite3.connect(fn)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS blame ("
+            "commit_sha TEXT, path TEXT, options TEXT, value BLOB, size INTEGER, last_used REAL, "
+            "PRIMARY KEY (commit_sha, path, options))"
+        )
+        self.conn.execute(
+            "CREATE INDEX IF NOT EXISTS blame_last_used ON blame (last_used)"
+        )
+        self.conn.execute(
+            "DROP TABLE IF EXISTS path_filter"
+        )  # Older layout, with the whole filter key in every row
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS filters ("
+            "id INTEGER PRIMARY KEY, key TEXT UNIQUE, size INTEGER, last_used REAL)"
+        )
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS filter_paths ("
+            "filter_id INTEGER, path BLOB, ok INTEGER, PRIMARY KEY (filter_id, path))"
+        )
+        self.conn.commit()
+        (self.size,) = self.conn.execute(
+            "SELECT (SELECT COALESCE(SUM(size), 0) FROM blame) + "
+            "(SELECT COALESCE(SUM(size), 0) FROM filters)"
+        ).fetchone()
+        self.used = []  # Keys of entries read since the last commit
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, commit_sha, path):
+        path = encode_path(path)
+        row = self.conn.execute(
+            "SELECT value FROM blame WHERE commit_sha = ? AND path = ? AND options = ?",
+            (commit_sha, path, self.options),
+        ).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.used.append((commit_sha, path, self.options))
+        return json.loads(zlib.decompress(row[0]))
+
+    def put(self, commit_sha, path, runs):
+        value = zlib.compress(json.dumps(runs).encode())
+        self.conn.execute(
+            "INSERT OR REPLACE INTO blame VALUES (?, ?, ?, ?, ?, ?)",
+            (
+                commit_sha,
+                encode_path(path),
+                self.options,
+                value,
+                len(value),
+                time.time(),
+            ),
+        )
+        self.size += len(value)
+
+    def get_path_filter(self, filter_key):
+        row = self.conn.execute(
+            "SELECT id FROM filters WHERE key = ?", (filter_key,)
+        ).fetchone()
+        if row is None:
+            return {}
+        self.conn.execute(
+            "UPDATE filters SET last_used = ? WHERE id = ?", (time.time(), row[0])
+        )
+        return {
+            path.decode("utf-8", "surrogateescape"): bool(ok)
+            for path, ok in self.conn.execute(
+                "SELECT path, ok FROM filter_paths WHERE filter_id = ?", row
+            )
+        }
+
+    def put_path_filter(self, filter_key, paths_ok):
+        self.conn.execute(
+            "INSERT OR IGNORE INTO filters (key, size, last_used) VALUES (?, 0, ?)",
+            (filter_key, time.time()),
+        )
+        (filter_id,) = self.conn.execute(
+            "SELECT id FROM filters WHERE key = ?", (filter_key,)
+        ).fetchone()
+        rows = [(filter_id, encode_path(path), ok) for path, ok in paths_ok.items()]
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO filter_paths VALUES (?, ?, ?)", rows
+        )
+        size = sum(len(path) + FILTER_PATH_OVERHEAD for _, path, _ in rows)
+        self.conn.execute(
+            "UPDATE filters SET size = size + ?, last_used = ? WHERE id = ?",
+            (size, time.time(), filter_id),
+        )
+        self.size += size
+        self.conn.commit()
+
+    def commit(self):
+        # Called once per analyzed commit, so an interrupted run can resume from there
+        now = time.time()
+        self.conn.executemany(
+            "UPDATE blame SET last_used = ? WHERE commit_sha = ? AND path = ? AND options = ?",
+            ((now,) + key for key in self.used),
+        )
+        self.used = []
+        if self.size > self.max_size:
+            self.evict()
+        self.conn.commit()
+
+    def evict(self):
+        # Drop the least recently used entries until we're comfortably below the size cap
+        target = 0.9 * self.max_size
+        evicted = []
+        evicted_filters = []
+        for table, rowid, size, _ in self.conn.execute(
+            "SELECT 'blame', rowid, size, last_used FROM blame "
+            "UNION ALL SELECT 'filters', id, size, last_used FROM filters "
+            "ORDER BY last_used"
+        ).fetchall():
+            if self.size <= target:
+                break
+            (evicted if table == "blame" else evicted_filters).append((rowid,))
+            self.size -= size
+        self.conn.executemany("DELETE FROM blame WHERE rowid = ?", evicted)
+        self.conn.executemany(
+            "DELETE FROM filter_paths WHERE filter_id = ?", evicted_filters
+        )
+        self.conn.executemany("DELETE FROM filters WHERE id = ?", evicted_filters)
+
+    def close(self):
+        if self.conn is not None:
+            self.commit()
+            self.conn.close()
+            self.conn = None
@@ -14,22 +14,19 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import matplotlib
+import argparse
 
-matplotlib.use("Agg")
-
-import argparse, dateutil.parser, json, numpy, sys
-from matplotlib import pyplot
-
-
-from .utils import generate_n_colors
+from .utils import generate_n_colors, get_pyplot, load_curves
 
 
 def line_plot(
     input_fn, display=False, outfile="line_plot.png", max_n=20, normalize=False
 ):
-    data = json.load(open(input_fn))  # TODO do we support multiple arguments here?
-    y = numpy.array(data["y"])
+    import numpy
+
+    pyplot = get_pyplot()
+    data = load_curves(input_fn)  # TODO do we support multiple arguments here?
+    y = data["y"]
     y_sums = numpy.sum(y, axis=0)
     if y.shape[0] > max_n:
         js = sorted(range(len(data["labels"])), key=lambda j: max(y[j]), reverse=True)
@@ -42,7 +39,7 @@ def line_plot(
         y = 100.0 * y / y_sums
     pyplot.figure(figsize=(16, 12), dpi=120)
     pyplot.style.use("ggplot")
-    ts = [dateutil.parser.parse(t) for t in data["ts"]]
+    ts = data["ts"]
     colors = generate_n_colors(len(labels))
     for color, label, series in zip(colors, labels, y):
         pyplot.plot(ts, series, color=color, label=label, linewidth=3)
@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2016 Erik Bernhardsson
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import argparse
+import calendar
+import glob
+import os
+import pickle
+
+from git_of_theseus.analyze import dump_results
+
+
+def load_shards(workdir):
+    shards = []
+    for fn in glob.glob(os.path.join(workdir, "shard_*_of_*.pickle")):
+        with open(fn, "rb") as f:
+            shards.append(pickle.load(f))
+    if not shards:
+        raise ValueError("No shards found in %s" % workdir)
+    first = shards[0]
+    for shard in shards:
+        if (
+            any(
+                shard[key] != first[key]
+                for key in ["settings", "interval", "last_hexsha"]
+            )
+            or shard["shard"][1] != first["shard"][1]
+        ):
+            raise ValueError(
+                "The shards in %s weren't all made by the same run, with the same settings"
+                % workdir
+            )
+    n = first["shard"][1]
+    missing = sorted(set(range(1, n + 1)) - {shard["shard"][0] for shard in shards})
+    if missing:
+        raise ValueError(
+            "Shards %s of %d are missing from %s"
+            % (", ".join(map(str, missing)), n, workdir)
+        )
+    return sorted(shards, key=lambda shard: shard["shard"][0])
+
+
+def merge_shards(workdir, outdir=None, npz=False, quiet=False):
+    shards = load_shards(workdir)
+    ts = []
+    curve_key_tuples = set()
+    for shard in shards:
+        curve_key_tuples.update(shard["curve_key_tuples"])
+    curves = {key_tuple: [] for key_tuple in curve_key_tuples}
+    commit_history = {}
+    for shard in shards:
+        ts.extend(shard["ts"])
+        for key_tuple in curve_key_tuples:
+            # Extensions & dirs only have a curve in the shards where they showed up
+            curves[key_tuple].extend(
+                shard["curves"].get(key_tuple, [0] * len(shard["ts"]))
+            )
+
+        # Each shard has an entry at its first commit for all commits that had lines then, so
+        # commits without one were gone by then. Entries that didn't change the count are
+        # dropped, like a single run does
+        shard_history = shard["commit_history"]
+        first_ts = calendar.timegm(shard["ts"][0].timetuple())
+        for hexsha, history in commit_history.items():
+            if history[-1][1] != 0 and (
+                hexsha not in shard_history or shard_history[hexsha][0][0] != first_ts
+            ):
+                history.append((first_ts, 0))
+        for hexsha, shard_entries in shard_history.items():
+            history = commit_history.setdefault(hexsha, [])
+            for entry in shard_entries:
+                if not history or history[-1][1] != entry[1]:
+                    history.append(entry)
+
+    if not quiet:
+        print("Merged {:d} shards, {:d} commits analyzed".format(len(shards), len(ts)))
+    if outdir is None:
+        outdir = workdir
+    os.makedirs(outdir, exist_ok=True)
+    dump_results(
+        outdir,
+        ts,
+        curves,
+        curve_key_tuples,
+        commit_history,
+        npz,
+        quiet,
+    )
+
+
+def merge_shards_cmdline():
+    parser = argparse.ArgumentParser(
+        description="Merge the shards of a sharded git-of-theseus-analyze run"
+    )
+    parser.add_argument(
+        "--outdir",
+        help="Output directory to store results (default: the shard directory)",
+    )
+    parser.add_argument(
+        "--npz",
+        action="store_true",
+        help="Also write the results as uncompressed NumPy .npz files next to the .json ones (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--quiet",
+        action="store_true",
+        help="Disable all console output (default: %(default)s)",
+    )
+    parser.add_argument(
+        "workdir", help="Directory with the shard_K_of_N.pickle files of all shards"
+    )
+    kwargs = vars(parser.parse_args())
+
+    merge_shards(**kwargs)
+
+
+if __name__ == "__main__":
+    merge_shards_cmdline()
@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2016 Erik Bernhardsson
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import os
+import sys
+
+# Name, type, help of each metric in Prometheus textfiles, all prefixed by "theseus_"
+PROMETHEUS_METRICS = [
+    ("commits", "counter", "Commits analyzed"),
+    ("entries", "counter", "Files at all analyzed commits"),
+    ("blamed_entries", "counter", "Files that changed, and had to be blamed"),
+    ("moved_entries", "counter", "Files that were moved, and kept their blame"),
+    ("git_processes", "counter", "Git processes started by the blame workers"),
+    ("git_process_seconds", "counter", "Time spent starting git processes"),
+    ("git_bytes_read", "counter", "Bytes of output read from git blame & diff"),
+    ("blob_bytes", "counter", "Bytes of all files that had to be blamed"),
+    ("chunks_sent", "counter", "Chunks of files sent to the blame workers"),
+    (
+        "results_received",
+        "counter",
+        "Chunks of results received from the blame workers",
+    ),
+    ("cache_hits", "counter", "Files found in the blame cache"),
+    ("cache_misses", "counter", "Files not found in the blame cache"),
+    ("worker_idle_seconds", "counter", "Time the blame workers spent waiting for work"),
+    ("worker_busy_seconds", "counter", "Time the blame workers spent working"),
+    ("peak_rss_mb", "gauge", "Peak RSS of the main process"),
+    (
+        "worker_peak_rss_mb",
+        "gauge",
+        "Peak RSS of the blame workers & their git processes",
+    ),
+]
+
+
+def get_peak_rss_mb(children=False):
+    # Of the processes that are done & waited for, with children=True. Only available on Unix
+    try:
+        import resource
+    except ImportError:
+        return None
+    rusage = resource.getrusage(
+        resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF
+    )
+    return rusage.ru_maxrss / (1024 * 1024 if sys.platform == "darwin" else 1024)
+
+
+def get_rss_mb():
+    # Current RSS, from /proc on Linux. Elsewhere the peak RSS is the closest thing there is
+    try:
+        with open("/proc/self/statm") as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+    except (OSError, ValueError, AttributeError):
+        return get_peak_rss_mb()
+
+
+def format_labels(**labels):
+    return ",".join(
+        '{:s}="{:s}"'.format(
+            key,
+            str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"),
+        )
+        for key, value in labels.items()
+    )
+
+
+def format_prometheus(stats, repo_dir):
+    lines = []
+
+    def add(name, metric_type, help_text, samples):
+        lines.append("# HELP theseus_{:s} {:s}".format(name, help_text))
+        lines.append("# TYPE theseus_{:s} {:s}".format(name, metric_type))
+        for suffix, labels, value in samples:
+            lines.append(
+                "theseus_{:s}{:s}{{{:s}}} {!r}".format(
+                    name, suffix, format_labels(repo=repo_dir, **labels), value
+                )
+            )
+
+    for name, metric_type, help_text in PROMETHEUS_METRICS:
+        if stats.get(name) is not None:
+            add(name, metric_type, help_text, [("", {}, stats[name])])
+    add(
+        "phase_seconds",
+        "gauge",
+        "Time spent in each phase of the analysis",
+        [("", {"phase": phase}, t) for phase, t in stats["phase_seconds"].items()],
+    )
+    if "file_blame_seconds" in stats:
+        histogram = stats["file_blame_seconds"]
+        samples = []
+        count = 0
+        for bucket, n in zip(histogram["buckets"] + ["+Inf"], histogram["counts"]):
+            count += n
+            samples.append(("_bucket", {"le": bucket}, count))
+        samples.append(("_sum", {}, histogram["sum"]))
+        samples.append(("_count", {}, count))
+        add(
+            "file_blame_seconds",
+            "histogram",
+            "Time it took to blame each file",
+            samples,
+        )
+    return "\n".join(lines) + "\n"
+
+
+def write_metrics(fn, stats, repo_dir):
+    # Written to a temporary file first, so a Prometheus textfile collector never sees half of it
+    tmp_fn = fn + ".tmp"
+    with open(tmp_fn, "w") as f:
+        if fn.endswith(".prom"):
+            f.write(format_prometheus(stats, repo_dir))
+        else:
+            json.dump(dict(stats, repo_dir=repo_dir), f, indent=2)
+    os.replace(tmp_fn, fn)
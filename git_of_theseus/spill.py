@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2016 Erik Bernhardsson
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+
+import numpy
+
+
+class CurveSpill:
+    """Append-only file of the counts of every curve at every analyzed commit.
+
+    Stands in for the `curves` dict of analyze() when memory is tight: each commit appends a row
+    to the file, and once the analysis is done, `curves[key_tuple]` reads a column back from a
+    memory map. Only one curve at a time is in RAM while the results are written. Curves added
+    along the way get a column at the end, and count as zero in the rows written before them.
+    """
+
+    def __init__(self, fn, curve_keys):
+        self.fn = fn
+        self.columns = {key_tuple: i for i, key_tuple in enumerate(curve_keys)}
+        self.f = open(fn, "wb")
+        self.row_lengths = []
+        self.data = None
+
+    def add_column(self, key_tuple):
+        self.columns[key_tuple] = len(self.columns)
+
+    def append(self, counts):
+        self.f.write(numpy.asarray(counts, dtype=numpy.int64).tobytes())
+        self.row_lengths.append(len(counts))
+
+    def finish(self):
+        self.f.close()
+        self.row_lengths = numpy.array(self.row_lengths, dtype=numpy.int64)
+        self.offsets = numpy.cumsum(self.row_lengths) - self.row_lengths
+        if os.path.getsize(self.fn) == 0:  # Can't memory-map an empty file
+            self.data = numpy.zeros(0, dtype=numpy.int64)
+        else:
+            self.data = numpy.memmap(self.fn, dtype=numpy.int64, mode="r")
+
+    def __getitem__(self, key_tuple):
+        column = self.columns[key_tuple]
+        y = numpy.zeros(len(self.row_lengths), dtype=numpy.int64)
+        rows = self.row_lengths > column
+        y[rows] = self.data[self.offsets[rows] + column]
+        return y.tolist()
+
+    def close(self):
+        self.data = None
+        os.remove(self.fn)
+
+
+class HistorySpill:
+    """Append-only file of the survival history entries, i.e. (sha key id, time, line count).
+
+    Stands in for the `commit_history` dict of analyze() when memory is tight. Once the analysis
+    is done, the entries are grouped by commit with a single argsort, and the commits come back
+    in the order they first showed up, like the dict would have them.
+    """
+
+    dtype = numpy.dtype([("sha_id", "i8"), ("ts", "i8"), ("count", "i8")])
+
+    def __init__(self, fn, key_index):
+        self.fn = fn
+        self.key_index = key_index
+        self.f = open(fn, "wb")
+        self.entries = None
+
+    def append(self, sha_ids, ts, counts):
+        entries = numpy.zeros(len(sha_ids), dtype=self.dtype)
+        entries["sha_id"] = sha_ids
+        entries["ts"] = ts
+        entries["count"] = counts
+        self.f.write(entries.tobytes())
+
+    def finish(self):
+        self.f.close()
+        if os.path.getsize(self.fn) == 0:  # Can't memory-map an empty file
+            self.entries = numpy.zeros(0, dtype=self.dtype)
+        else:
+            self.entries = numpy.memmap(self.fn, dtype=self.dtype, mode="r")
+        sha_ids = self.entries["sha_id"]
+        order = numpy.argsort(
+            sha_ids, kind="stable"
+        )  # Entries of each commit, in time order
+        starts = numpy.flatnonzero(
+            numpy.diff(sha_ids[order], prepend=-1)
+        )  # Where the entries of each commit start in `order`
+        self.order = order
+        self.bounds = numpy.append(starts, len(order))
+        self.commits = numpy.argsort(
+            order[starts], kind="stable"
+        )  # Commits, by their first entry
+
+    def __len__(self):
+        return len(self.commits)
+
+    def hexsha(self, i):
+        sha_id = self.entries["sha_id"][self.order[self.bounds[i]]]
+        return self.key_index.keys[sha_id][1].hex()
+
+    def items(self):
+        for i in self.commits.tolist():
+            entries = self.entries[self.order[self.bounds[i] : self.bounds[i + 1]]]
+            yield self.hexsha(i), list(
+                zip(entries["ts"].tolist(), entries["count"].tolist())
+            )
+
+    def arrays(self):
+        # (hexshas, offsets, ts, counts) of all commits, with the entries of commit i at
+        # offsets[i]:offsets[i + 1] of ts & counts
+        lengths = numpy.diff(self.bounds)[self.commits]
+        index = numpy.concatenate(
+            [
+                self.order[self.bounds[i] : self.bounds[i + 1]]
+                for i in self.commits.tolist()
+            ]
+            or [numpy.zeros(0, dtype=numpy.int64)]
+        )
+        return (
+            [self.hexsha(i) for i in self.commits.tolist()],
+            numpy.cumsum(numpy.append(0, lengths)),
+            self.entries["ts"][index],
+            self.entries["count"][index],
+        )
+
+    def close(self):
+        self.entries = None
+        os.remove(self.fn)
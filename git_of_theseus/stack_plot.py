@@ -14,21 +14,19 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import matplotlib
+import argparse
 
-matplotlib.use("Agg")
-
-import argparse, dateutil.parser, json, numpy, sys
-from matplotlib import pyplot
-
-from .utils import generate_n_colors
+from .utils import generate_n_colors, get_pyplot, load_curves
 
 
 def stack_plot(
     input_fn, display=False, outfile="stack_plot.png", max_n=20, normalize=False
 ):
-    data = json.load(open(input_fn))  # TODO do we support multiple arguments here?
-    y = numpy.array(data["y"])
+    import numpy
+
+    pyplot = get_pyplot()
+    data = load_curves(input_fn)  # TODO do we support multiple arguments here?
+    y = data["y"]
     if y.shape[0] > max_n:
         js = sorted(range(len(data["labels"])), key=lambda j: max(y[j]), reverse=True)
         other_sum = numpy.sum(y[j] for j in js[max_n:])
@@ -41,7 +39,7 @@ def stack_plot(
         y = 100.0 * numpy.array(y) / numpy.sum(y, axis=0)
     pyplot.figure(figsize=(16, 12), dpi=120)
     pyplot.style.use("ggplot")
-    ts = [dateutil.parser.parse(t) for t in data["ts"]]
+    ts = data["ts"]
     colors = generate_n_colors(len(labels))
     pyplot.stackplot(ts, numpy.array(y), labels=labels, colors=colors)
     pyplot.legend(loc=2)
@@ -14,60 +14,79 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import matplotlib
-
-matplotlib.use("Agg")
-
 import argparse
-import collections
-import json
 import math
 import os
 import sys
 
-import numpy
-from matplotlib import pyplot
+from .utils import get_pyplot, load_survival
+
+
+def get_survival_curve(commit_history):
+    # Kaplan-Meier estimate from the histories of all commits. Returns the times (in seconds since
+    # each commit was made) at which any line count changed, the number of lines still tracked
+    # just before each of these times, and the fraction of lines surviving just before & after each
+    import numpy
+
+    lengths = numpy.array(
+        [len(history) for history in commit_history], dtype=numpy.int64
+    )
+    pairs = numpy.array(
+        [pair for history in commit_history for pair in history], dtype=numpy.int64
+    ).reshape(-1, 2)
+    starts = numpy.cumsum(lengths) - lengths
+    ends = starts + lengths - 1
+    is_first = numpy.zeros(len(pairs), dtype=bool)
+    is_first[starts] = True
+
+    # Each count change adds lines lost, and the last entry of each commit removes all of its lines
+    dts = pairs[:, 0] - numpy.repeat(pairs[starts, 0], lengths)
+    delta_ks = numpy.diff(pairs[:, 1], prepend=0)
+    ts, inverse = numpy.unique(
+        numpy.concatenate([dts[~is_first], dts[ends]]), return_inverse=True
+    )
+    delta_k = numpy.bincount(
+        inverse,
+        numpy.concatenate([delta_ks[~is_first], -pairs[ends, 1]]).astype(float),
+        minlength=len(ts),
+    )
+    delta_n = numpy.bincount(
+        inverse,
+        numpy.concatenate(
+            [numpy.zeros((~is_first).sum()), -pairs[starts, 1].astype(float)]
+        ),
+        minlength=len(ts),
+    )
+
+    total_n = float(pairs[starts, 1].sum())
+    ns = total_n + numpy.concatenate([[0.0], numpy.cumsum(delta_n)[:-1]])
+    ps = numpy.concatenate([[1.0], numpy.cumprod(1 + delta_k / ns)])
+    return ts, ns, ps[:-1], ps[1:]
 
 
 def survival_plot(
     input_fns, exp_fit=False, display=False, outfile="survival_plot", years=5
 ):
-    all_deltas = []
+    import numpy
+
+    pyplot = get_pyplot()
+    all_curves = []
     YEAR = 365.25 * 24 * 60 * 60
     pyplot.figure(figsize=(13, 8))
     pyplot.style.use("ggplot")
 
     for fn in input_fns:
         print("reading %s" % fn)
-        commit_history = json.load(open(fn))
+        commit_history = load_survival(fn)
 
         print("counting %d commits" % len(commit_history))
-        deltas = collections.defaultdict(lambda: numpy.zeros(2))
-        total_n = 0
-        for commit, history in commit_history.items():
-            t0, orig_count = history[0]
-            total_n += orig_count
-            last_count = orig_count
-            for t, count in history[1:]:
-                deltas[t - t0] += (count - last_count, 0)
-                last_count = count
-            deltas[history[-1][0] - t0] += (-last_count, -orig_count)
-
-        all_deltas.append((total_n, deltas))
-        print("adding %d deltas..." % len(deltas))
-        total_k = total_n
-        P = 1.0
-        xs = []
-        ys = []
-        for t in sorted(deltas.keys()):
-            delta_k, delta_n = deltas[t]
-            xs.append(t / YEAR)
-            ys.append(100.0 * P)
-            P *= 1 + delta_k / total_n
-            total_k += delta_k
-            total_n += delta_n
-            if P < 0.05:
-                break
+        ts, ns, ps, next_ps = get_survival_curve(commit_history)
+        all_curves.append((ts / YEAR, ns, ps))
+        print("adding %d deltas..." % len(ts))
+        below = numpy.flatnonzero(next_ps < 0.05)
+        n_points = below[0] + 1 if len(below) else len(ts)  # Stop once below 5%
+        xs = (ts[:n_points] / YEAR).tolist()
+        ys = (100.0 * ps[:n_points]).tolist()
 
         print("plotting...")
         if exp_fit:
@@ -77,17 +96,11 @@ def survival_plot(
             pyplot.plot(xs, ys, label=(len(parts) > 1 and parts[-2] or None))
 
     def fit(k):
-        loss = 0.0
-        for total_n, deltas in all_deltas:
-            total_k = total_n
-            P = 1.0
-            for t in sorted(deltas.keys()):
-                delta_k, delta_n = deltas[t]
-                pred = total_n * math.exp(-k * t / YEAR)
-                loss += (total_n * P - pred) ** 2
-                P *= 1 + delta_k / total_n
-                total_k += delta_k
-                total_n += delta_n
+        k = numpy.ravel(k)[0]
+        loss = sum(
+            numpy.sum((ns * ps - ns * numpy.exp(-k * ts)) ** 2)
+            for ts, ns, ps in all_curves
+        )
         print(k, loss)
         return loss
 
@@ -14,10 +14,113 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import itertools, numpy
+import bisect, itertools, json, os, struct, zipfile
+
+
+def get_pyplot():
+    # Importing matplotlib is slow, so it's only done once something is actually plotted
+    import matplotlib
+
+    matplotlib.use("Agg")
+    from matplotlib import pyplot
+
+    return pyplot
+
+
+def load_npz(fn):
+    # numpy.load ignores mmap_mode for .npz files, so memory-map the arrays of the (uncompressed)
+    # archive ourselves, straight from the offsets of the zip entries
+    import numpy
+
+    arrays = {}
+    with zipfile.ZipFile(fn) as z, open(fn, "rb") as f:
+        for info in z.infolist():
+            name = info.filename[: -len(".npy")]
+            if info.compress_type != zipfile.ZIP_STORED:
+                arrays[name] = numpy.load(z.open(info))
+                continue
+            f.seek(
+                info.header_offset + 26
+            )  # Lengths of the name & extra fields of the local header
+            name_len, extra_len = struct.unpack("<HH", f.read(4))
+            f.seek(info.header_offset + 30 + name_len + extra_len)
+            version = numpy.lib.format.read_magic(f)
+            if version == (1, 0):
+                shape, fortran_order, dtype = numpy.lib.format.read_array_header_1_0(f)
+            else:
+                shape, fortran_order, dtype = numpy.lib.format.read_array_header_2_0(f)
+            if numpy.prod(shape) == 0:
+                arrays[name] = numpy.zeros(shape, dtype=dtype)
+                continue
+            arrays[name] = numpy.memmap(
+                fn,
+                dtype=dtype,
+                mode="r",
+                offset=f.tell(),
+                shape=shape,
+                order="F" if fortran_order else "C",
+            )
+    return arrays
+
+
+def load_curves(fn):
+    # Reads the output of `dump_json` or `dump_npz` from analyze
+    import dateutil.parser, numpy
+
+    if os.path.splitext(fn)[1] == ".npz":
+        data = load_npz(fn)
+        return {
+            "y": data["y"],
+            "ts": data["ts"].astype("datetime64[s]").tolist(),
+            "labels": data["labels"].tolist(),
+        }
+    data = json.load(open(fn))
+    return {
+        "y": numpy.array(data["y"]),
+        "ts": [dateutil.parser.parse(t) for t in data["ts"]],
+        "labels": data["labels"],
+    }
+
+
+def expand_history(changes, sample_ts):
+    # Fills in the line count of a commit at every analyzed time, from the times it changed
+    history = []
+    count = None
+    j = 0
+    for t in sample_ts[bisect.bisect_left(sample_ts, changes[0][0]) :]:
+        while j < len(changes) and changes[j][0] <= t:
+            count = changes[j][1]
+            j += 1
+        history.append((t, count))
+    return history
+
+
+def load_survival(fn):
+    # Returns the (timestamp, line count) history of each commit in a survival.json/.npz
+    if os.path.splitext(fn)[1] == ".npz":
+        data = load_npz(fn)
+        ts, counts, offsets = (data[k].tolist() for k in ("ts", "counts", "offsets"))
+        histories = [
+            list(zip(ts[start:end], counts[start:end]))
+            for start, end in zip(offsets[:-1], offsets[1:])
+        ]
+        sample_ts = data["sample_ts"].tolist() if "sample_ts" in data else None
+    else:
+        data = json.load(open(fn))
+        if "commits" in data:
+            histories = list(data["commits"].values())
+            sample_ts = data["ts"]
+        else:  # Written before only changes were kept
+            histories = list(data.values())
+            sample_ts = None
+    if sample_ts is None:
+        return histories
+    return [expand_history(changes, sample_ts) for changes in histories]
 
 
 def generate_n_colors(n):
+    import numpy
+
     vs = numpy.linspace(0.4, 0.9, 6)
     colors = [(0.9, 0.4, 0.4)]
 
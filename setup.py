@@ -19,6 +19,9 @@ setup(
     entry_points={
         "console_scripts": [
             "git-of-theseus-analyze=git_of_theseus.analyze:analyze_cmdline",
+            "git-of-theseus-batch-analyze=git_of_theseus.batch:batch_analyze_cmdline",
+            "git-of-theseus-merge-shards=git_of_theseus.merge:merge_shards_cmdline",
+            "git-of-theseus-benchmark=git_of_theseus.benchmark:benchmark_cmdline",
             "git-of-theseus-survival-plot=git_of_theseus:survival_plot_cmdline",
             "git-of-theseus-stack-plot=git_of_theseus:stack_plot_cmdline",
             "git-of-theseus-line-plot=git_of_theseus:line_plot_cmdline",